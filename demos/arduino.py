@@ -6,12 +6,23 @@ A simple api to change the color of a light
 """
 
 import string
+import time
 import logging
+from array import array
+from itertools import izip
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 from twisted.internet import defer
 from twisted.internet import reactor
 from twisted.internet import protocol
 from twisted.protocols import basic
+from twisted.python import failure
+
+import metrics
 
 
 RED = 'zaa'
@@ -20,25 +31,109 @@ BLUE = 'aaz'
 WHITE = 'zzz'
 BLACK = 'aaa'
 
+GET_DATA = metrics.counter('arduino_get_data_total', 'Device.get_data() calls')
+SET_COLOR = metrics.counter('arduino_set_color_total', 'Device.set_color() calls')
+READS = metrics.counter('arduino_reads_total', 'Requests sent to the device')
+READ_ERRORS = metrics.counter('arduino_read_errors_total', 'Device requests that failed')
+READ_SECONDS = metrics.histogram('arduino_read_seconds', 'Device request round trip time')
+
+
+def rgb_to_color(r, g, b):
+    """
+    Quantize r, g, b values into the three letter color string the
+    device understands.
+    """
+    scale = string.ascii_letters
+    return "%s%s%s" % tuple([scale[int(abs(c)) % 52] for c in (r,g,b,)])
+
+
+def counts_to_si(tempCts, rhCts):
+    """
+    Convert raw ADC counts into SI units as per datasheets, many readings
+    at a time.
+
+    tempCts and rhCts are equal length sequences of counts. Returns
+    (temp, humidity) arrays in degrees C and corrected %RH: NumPy arrays
+    if NumPy is installed, array('d') otherwise. Both paths perform the
+    same float operations in the same order, so they agree exactly.
+    """
+    if numpy is None:
+        return _counts_to_si(tempCts, rhCts)
+
+    rhVolts = numpy.asarray(rhCts, dtype=numpy.float64) * 0.0048828125
+
+    # 10mV/degree, 1024 count/5V
+    temp = numpy.asarray(tempCts, dtype=numpy.float64) * 0.48828125
+    # RH temp correction is -0.7% per deg C
+    rhcf = (-0.7 * (temp - 25.0)) / 100.0
+
+    # Uncorrected humidity
+    humidity = (rhVolts * 45.25) - 42.76
+
+    # Add correction factor
+    humidity += rhcf * humidity
+    return temp, humidity
+
+
+def _counts_to_si(tempCts, rhCts):
+    """
+    Pure Python counts_to_si.
+    """
+    temps = array('d')
+    humidities = array('d')
+    for tempCt, rhCt in izip(tempCts, rhCts):
+        rhVolts = rhCt * 0.0048828125
+        temp = tempCt * 0.48828125
+        rhcf = (-0.7 * (temp - 25.0)) / 100.0
+        humidity = (rhVolts * 45.25) - 42.76
+        temps.append(temp)
+        humidities.append(humidity + (rhcf * humidity))
+    return temps, humidities
+
 
 class Device(object):
     """
     the service
     """
 
-    def __init__(self, hostname='ooi-arduino.ucsd.edu', port=80):
+    def __init__(self, hostname='ooi-arduino.ucsd.edu', port=80, pool_size=0,
+                 ttl=0, connect_timeout=30, read_timeout=10):
+        """
+        pool_size > 0 keeps up to that many connections open and reuses
+        them, instead of one TCP connect per call.
+        ttl is how many seconds a reading stays fresh; get_data() calls
+        inside that window are answered from the last sample.
+        connect_timeout and read_timeout are in seconds; a read that
+        misses its deadline fails with defer.TimeoutError.
+
+        Set history to a history.History to record every reading under
+        history_name ('hostname:port' by default), and samplelog to a
+        two field samplelog.SampleLog to write them to disk.
+        """
         self.hostname = hostname
         self.port = port
         self.temp = None
         self.humidity = None
         self.color = WHITE
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.pool = None
+        if pool_size:
+            self.pool = ArduinoPool(hostname, port, pool_size,
+                                    connect_timeout, read_timeout)
+        self.ttl = ttl
+        self.sampled = None
+        self._waiters = None
+        self._reading = None
+        self.history = None
+        self.samplelog = None
+        self.history_name = '%s:%s' % (hostname, port)
+        self.stats = {'hits':0, 'misses':0, 'coalesced':0}
 
     def set_colorRGB(self, r, g, b):
         """
         """
-        scale = string.ascii_letters
-
-        rgb = "%s%s%s" % tuple([scale[int(abs(c)) % 52] for c in (r,g,b,)])
+        rgb = rgb_to_color(r, g, b)
         print 'RGB', rgb
         return self.set_color(rgb)
 
@@ -47,6 +142,7 @@ class Device(object):
         """
 
         self.color = rgb
+        SET_COLOR.inc()
 
         def success(client):
             return True
@@ -54,23 +150,107 @@ class Device(object):
         def fail(reason):
             return False
 
-        d = self._connect()
+        d = self._read_data()
         d.addCallback(success)
         d.addErrback(fail)
         return d
 
     def get_data(self):
+        """
+        Concurrent calls share one read of the device, and a reading
+        younger than ttl is returned without touching it at all.
+
+        Cancelling the returned Deferred drops this caller; when no
+        callers are left the read itself is cancelled and its connection
+        closed.
+        """
+        GET_DATA.inc()
+        if self.ttl and self.sampled is not None and \
+                time.time() - self.sampled < self.ttl:
+            self.stats['hits'] += 1
+            return defer.succeed((self.temp, self.humidity,))
+
+        d = defer.Deferred(self._cancel_waiter)
+        if self._waiters is not None:
+            self.stats['coalesced'] += 1
+            self._waiters.append(d)
+            return d
+
+        self.stats['misses'] += 1
+        self._waiters = [d]
+        self._reading = read = self._read_data()
+        read.addBoth(self._got_data)
+        return d
+
+    def _cancel_waiter(self, d):
+        if self._waiters is None or d not in self._waiters:
+            return
+        self._waiters.remove(d)
+        if not self._waiters and self._reading is not None:
+            self._reading.cancel()
+
+    def _got_data(self, result):
+        waiters, self._waiters = self._waiters, None
+        self._reading = None
+        if isinstance(result, failure.Failure):
+            for d in waiters:
+                d.errback(result)
+            return
+        self.temp, self.humidity = result
+        self.sampled = time.time()
+        if self.history is not None:
+            self.history.record(self.history_name, self.sampled, result)
+        if self.samplelog is not None:
+            self.samplelog.append(self.sampled, result)
+        for d in waiters:
+            d.callback(result)
+
+    def _read_data(self):
 
         def _return_data(client):
             return client.deferred
 
-        d = self._connect()
-        d.addCallback(_return_data)
+        READS.inc()
+        if self.pool is not None:
+            d = self._pooled_request()
+        else:
+            d = self._connect()
+            d.addCallback(_return_data)
+        d.addBoth(self._timed, time.time())
         return d
 
+    def _timed(self, result, started):
+        READ_SECONDS.observe(time.time() - started)
+        if isinstance(result, failure.Failure):
+            READ_ERRORS.inc()
+        return result
+
+    def _pooled_request(self):
+        """
+        Send the current color over a pooled connection. The Deferred
+        fires with the (temp, humidity) reply.
+        """
+        color = self.color
+
+        def _request(client):
+            d = client.request(color)
+            d.addBoth(self._release, client)
+            return d
+
+        d = self.pool.acquire()
+        d.addCallback(_request)
+        d.addErrback(self._connect_err)
+        return d
+
+    def _release(self, result, client):
+        self.pool.release(client)
+        return result
+
     def _connect(self):
-        client_creator = protocol.ClientCreator(reactor, ArduinoClient, self.color)
-        d = client_creator.connectTCP(self.hostname, self.port)
+        client_creator = protocol.ClientCreator(reactor, ArduinoClient, self.color,
+                                                timeout=self.read_timeout)
+        d = client_creator.connectTCP(self.hostname, self.port,
+                                      timeout=self.connect_timeout)
         d.addErrback(self._connect_err)
         return d
 
@@ -79,56 +259,261 @@ class Device(object):
         return reason
 
 
+class ColorScheduler(object):
+    """
+    Latest value wins rate limiter in front of Device.set_color.
+
+    At most one command is in flight. Colors submitted meanwhile replace
+    each other (merged), and colors equal to the one already sent or
+    pending are not sent at all (dropped).
+    """
+
+    def __init__(self, device):
+        self.device = device
+        self.sent = None
+        self.pending = None
+        self.busy = False
+        self.stats = {'sent':0, 'merged':0, 'dropped':0}
+
+    def set_colorRGB(self, r, g, b):
+        self.set_color(rgb_to_color(r, g, b))
+
+    def set_color(self, rgb):
+        if self.pending is not None:
+            current = self.pending
+        else:
+            current = self.sent
+        if rgb == current:
+            self.stats['dropped'] += 1
+            return
+
+        if not self.busy:
+            self._send(rgb)
+            return
+
+        if self.pending is not None:
+            self.stats['merged'] += 1
+        if rgb == self.sent:
+            self.pending = None
+        else:
+            self.pending = rgb
+
+    def _send(self, rgb):
+        self.busy = True
+        self.sent = rgb
+        self.stats['sent'] += 1
+        d = self.device.set_color(rgb)
+        d.addBoth(self._done)
+
+    def _done(self, result):
+        self.busy = False
+        if result is False:
+            # Device.set_color failed; the LED may not show self.sent, so
+            # do not drop the next request for the same color
+            self.sent = None
+        if self.pending is not None:
+            rgb, self.pending = self.pending, None
+            self._send(rgb)
+        return result
+
+
+class ArduinoPool(object):
+    """
+    A bounded set of long lived ArduinoClient connections to one device.
+
+    acquire() hands out an idle, healthy connection (a hit), opens a new
+    one if under the limit (a miss), or queues the caller until one is
+    released (a wait; the connection it then gets also counts as a hit).
+    Broken connections are dropped and replaced, as are connection
+    attempts that fail while callers are waiting.
+    """
+
+    def __init__(self, hostname, port, size=2, connect_timeout=30,
+                 read_timeout=10):
+        self.hostname = hostname
+        self.port = port
+        self.size = size
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self._idle = []
+        self._waiting = []
+        self._opened = 0
+        self.stats = {'hits':0, 'misses':0, 'waits':0, 'wait_time':0.0,
+                      'reconnects':0}
+
+    def acquire(self):
+        while self._idle:
+            client = self._idle.pop()
+            if client.connected:
+                self.stats['hits'] += 1
+                return defer.succeed(client)
+            self._discard(client)
+        if self._opened < self.size:
+            self.stats['misses'] += 1
+            return self._open()
+        self.stats['waits'] += 1
+        d = defer.Deferred(self._cancel_wait)
+        self._waiting.append((time.time(), d))
+        return d
+
+    def _cancel_wait(self, d):
+        self._waiting = [(t, w) for (t, w) in self._waiting if w is not d]
+
+    def release(self, client):
+        if not client.connected:
+            self._discard(client)
+        elif self._waiting:
+            self.stats['hits'] += 1
+            self._hand_off(defer.succeed(client))
+        else:
+            self._idle.append(client)
+
+    def _open(self):
+        self._opened += 1
+        client_creator = protocol.ClientCreator(reactor, ArduinoClient,
+                                                keepAlive=True,
+                                                timeout=self.read_timeout)
+        d = client_creator.connectTCP(self.hostname, self.port,
+                                      timeout=self.connect_timeout)
+        d.addErrback(self._open_err)
+        return d
+
+    def _open_err(self, reason):
+        self._opened -= 1
+        logging.debug('Pool connection error %s' % (reason,))
+        # Nothing will be released for the callers queued behind this
+        # attempt, so the next one gets an attempt of its own
+        if self._waiting:
+            self.stats['reconnects'] += 1
+            self._hand_off(self._open())
+        return reason
+
+    def _discard(self, client):
+        """
+        Forget a dead connection, reconnecting for the next waiter if any.
+        """
+        self._opened -= 1
+        if self._waiting:
+            self.stats['reconnects'] += 1
+            self._hand_off(self._open())
+
+    def _hand_off(self, d):
+        started, waiter = self._waiting.pop(0)
+        self.stats['wait_time'] += time.time() - started
+        d.chainDeferred(waiter)
+
+
+class BadReading(ValueError):
+    """
+    The device answered with something other than "tempCts rhCts".
+    """
+
+
 class ArduinoClient(basic.LineReceiver):
 
-    def __init__(self, color=WHITE):
+    def __init__(self, color=WHITE, keepAlive=False, timeout=None):
         """
         color value to set light to
+        keepAlive leaves the connection open for further request() calls
+        timeout is how many seconds to wait for the reading, None forever
         """
         self._color = color
+        self.keepAlive = keepAlive
+        self.timeout = timeout
         self.lastTemp = None
         self.lastRH = None
-        self.deferred = defer.Deferred()
+        self._timer = None
+        self.deferred = None
+        if not keepAlive:
+            self.deferred = defer.Deferred(self._cancel)
 
     def connectionMade(self):
         #global current_color
+        if self.keepAlive:
+            return
         logging.info('Connected! Sending color ' + self._color)
         self.transport.write(self._color + '\n')
+        self._startTimer()
+
+    def connectionLost(self, reason):
+        self.connected = 0
+        self._stopTimer()
+        self._fail(reason)
+
+    def request(self, color):
+        """
+        Send a color on a kept alive connection. The returned Deferred
+        fires with the next (temp, humidity) reading.
+        """
+        self._color = color
+        self.deferred = defer.Deferred(self._cancel)
+        logging.info('Sending color ' + color)
+        self.transport.write(color + '\n')
+        self._startTimer()
+        return self.deferred
 
     def lineReceived(self, line):
+        self._stopTimer()
         logging.info('sensor data: "%s"' % line)
         data = line.split()
         self.processData(data)
+        if not self.keepAlive:
+            self.transport.loseConnection()
+
+    def abort(self):
+        """
+        Close the connection and keep it from being reused.
+        """
+        self.connected = 0
         self.transport.loseConnection()
 
-    def processData(self, data):
-        """Convert raw ADC counts into SI units as per datasheets"""
-        # Skip bad reads
-        if len(data) != 2:
-            return
+    def _startTimer(self):
+        if self.timeout:
+            self._timer = reactor.callLater(self.timeout, self._timedOut)
 
-        tempCts = int(data[0])
-        rhCts = int(data[1])
+    def _stopTimer(self):
+        if self._timer is not None and self._timer.active():
+            self._timer.cancel()
+        self._timer = None
 
-        rhVolts = rhCts * 0.0048828125
+    def _timedOut(self):
+        self._timer = None
+        # Abort first, so the errback does not hand this connection back
+        # to the pool as if it were still usable
+        self.abort()
+        self._fail(defer.TimeoutError('no reading within %s seconds' %
+                                      (self.timeout,)))
 
-        # 10mV/degree, 1024 count/5V
-        temp = tempCts * 0.48828125
-        # RH temp correction is -0.7% per deg C
-        rhcf = (-0.7 * (temp - 25.0)) / 100.0
+    def _cancel(self, d):
+        # Deferred.cancel errbacks d with CancelledError once we return
+        self._stopTimer()
+        self.abort()
 
-        # Uncorrected humidity
-        humidity = (rhVolts * 45.25) - 42.76
+    def _fail(self, reason):
+        if self.deferred is not None and not self.deferred.called:
+            self.deferred.errback(reason)
+
+    def processData(self, data):
+        """Convert raw ADC counts into SI units as per datasheets"""
+        try:
+            tempCts, rhCts = map(int, data)
+        except ValueError:
+            logging.info('Bad reading %r' % (data,))
+            self.abort()
+            self._fail(BadReading('expected "tempCts rhCts", got %r' % (data,)))
+            return
 
-        # Add correction factor
-        humidity = humidity + (rhcf * humidity)
+        temps, humidities = counts_to_si((tempCts,), (rhCts,))
+        temp = float(temps[0])
+        humidity = float(humidities[0])
 
         self.lastTemp = temp
         self.lastRH = humidity
-        self.deferred.callback((temp, humidity,))
+        if self.deferred is not None and not self.deferred.called:
+            self.deferred.callback((temp, humidity,))
 
         logging.info('Temp: %f C Relative humidity: %f %%' % (temp, humidity))
-        logging.debug('Temp: %f counts: %d RH: %f counts: %d volts: %f' % (temp, tempCts, humidity, rhCts, rhVolts))
+        logging.debug('Temp: %f counts: %d RH: %f counts: %d' % (temp, tempCts, humidity, rhCts))
 
 
 
@@ -0,0 +1,59 @@
+#!/usr/bin/env python
+
+"""
+Time arduino.counts_to_si on a batch of raw readings, against the scalar
+per-reading loop it replaced, and check both give the same numbers.
+
+$ python bench_convert.py [readings]
+"""
+import sys
+import random
+import timeit
+
+import arduino
+
+
+def scalar(tempCts, rhCts):
+    """
+    The old ArduinoClient.processData math, one reading at a time.
+    """
+    out = []
+    for tempCt, rhCt in zip(tempCts, rhCts):
+        rhVolts = rhCt * 0.0048828125
+        temp = tempCt * 0.48828125
+        rhcf = (-0.7 * (temp - 25.0)) / 100.0
+        humidity = (rhVolts * 45.25) - 42.76
+        humidity = humidity + (rhcf * humidity)
+        out.append((temp, humidity))
+    return out
+
+
+def main(n):
+    tempCts = [random.randint(0, 1023) for i in xrange(n)]
+    rhCts = [random.randint(0, 1023) for i in xrange(n)]
+
+    temps, humidities = arduino.counts_to_si(tempCts, rhCts)
+    assert zip(list(temps), list(humidities)) == scalar(tempCts, rhCts)
+
+    if arduino.numpy is not None:
+        # Arrays as they would come out of an archive
+        batch = (arduino.numpy.array(tempCts), arduino.numpy.array(rhCts))
+    else:
+        batch = (tempCts, rhCts)
+
+    runs = 5
+    t_scalar = min(timeit.repeat(lambda: scalar(tempCts, rhCts),
+                                 number=1, repeat=runs))
+    t_batch = min(timeit.repeat(lambda: arduino.counts_to_si(*batch),
+                                number=1, repeat=runs))
+    print '%d readings, numpy %s' % (n, arduino.numpy is not None)
+    print 'scalar loop:  %.4f s (%.0f readings/s)' % (t_scalar, n / t_scalar)
+    print 'counts_to_si: %.4f s (%.0f readings/s)' % (t_batch, n / t_batch)
+    print 'speedup:      %.1fx' % (t_scalar / t_batch)
+
+
+if __name__ == '__main__':
+    n = 1000000
+    if len(sys.argv) > 1:
+        n = int(sys.argv[1])
+    main(n)
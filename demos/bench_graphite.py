@@ -0,0 +1,51 @@
+#!/usr/bin/env python
+
+"""
+Bytes on the wire and CPU time per motion sample for GraphiteSender
+(plaintext lines) against PickleGraphiteSender (Carbon pickle batches).
+
+$ python bench_graphite.py [samples]
+
+Both senders write into an in-memory StringTransport, so only the
+formatting and framing is measured, not the network.
+"""
+import sys
+import time
+import random
+
+from twisted.test import proto_helpers
+
+import motion
+
+
+def run(senderClass, samples):
+    sender = senderClass()
+    transport = proto_helpers.StringTransport()
+    sender.makeConnection(transport)
+    started = time.clock()
+    now = time.time()
+    for msg in samples:
+        sender.sendMessage(msg, now)
+    if hasattr(sender, 'flush'):
+        sender.flush()
+    cpu = time.clock() - started
+    sender.connectionLost(None)
+    return len(transport.value()), cpu
+
+
+def main(n):
+    samples = [[random.uniform(-50, 50), random.uniform(-50, 50),
+                random.uniform(200, 300)] for i in xrange(n)]
+    print '%d samples' % n
+    print '%-22s %12s %10s %12s' % ('sender', 'bytes', 'B/sample', 'us/sample')
+    for senderClass in (motion.GraphiteSender, motion.PickleGraphiteSender):
+        nbytes, cpu = run(senderClass, samples)
+        print '%-22s %12d %10.1f %12.2f' % (senderClass.__name__, nbytes,
+                                            float(nbytes) / n, cpu * 1e6 / n)
+
+
+if __name__ == '__main__':
+    n = 100000
+    if len(sys.argv) > 1:
+        n = int(sys.argv[1])
+    main(n)
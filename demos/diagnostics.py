@@ -0,0 +1,164 @@
+#!/usr/bin/env python
+
+"""
+Is the reactor thread blocked, and by what?
+
+LagMonitor schedules a call every interval seconds and records how late
+it actually runs in the reactor_lag_seconds histogram (see /metrics). A
+healthy reactor stays in the lowest buckets; anything blocking it, like
+a synchronous file read, shows up as lag.
+
+SamplingProfiler is a thread that looks at the reactor thread's stack
+every interval seconds and counts the stacks it sees, collapsed into
+the "outer;...;inner count" lines flamegraph.pl reads. It never touches
+the reactor thread itself, so it is cheap enough to leave on.
+ProfilerResource starts, stops and dumps it over HTTP:
+
+    $ curl -d action=start http://localhost:8000/profile
+    $ curl http://localhost:8000/profile > stacks.txt
+    $ flamegraph.pl stacks.txt > reactor.svg
+"""
+import os
+import sys
+import time
+import thread
+import threading
+import collections
+
+from twisted.internet import reactor
+from twisted.web import resource
+from twisted.web import http
+
+import metrics
+
+LAG_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0,
+               2.5)
+
+
+class LagMonitor(object):
+
+    def __init__(self, interval=0.1):
+        self.interval = interval
+        self.histogram = metrics.histogram('reactor_lag_seconds',
+                                           'How late scheduled calls run',
+                                           LAG_BUCKETS)
+        self.worst = metrics.gauge('reactor_lag_max_seconds',
+                                   'Largest lag seen')
+        self._call = None
+        self._expected = None
+
+    def start(self):
+        self._schedule()
+
+    def stop(self):
+        if self._call is not None and self._call.active():
+            self._call.cancel()
+        self._call = None
+
+    def _schedule(self):
+        self._expected = time.time() + self.interval
+        self._call = reactor.callLater(self.interval, self._tick)
+
+    def _tick(self):
+        lag = max(0.0, time.time() - self._expected)
+        self.histogram.observe(lag)
+        if lag > self.worst.value:
+            self.worst.set(lag)
+        self._schedule()
+
+
+class SamplingProfiler(object):
+    """
+    Samples the stack of the thread that created it (normally the
+    reactor thread) until stopped.
+    """
+
+    def __init__(self, interval=0.005):
+        self.interval = interval
+        self.thread_id = thread.get_ident()
+        self.counts = collections.defaultdict(int)
+        self.samples = 0
+        self.running = False
+        self._thread = None
+        self._stopped = None
+
+    def start(self):
+        if self.running:
+            return
+        self.running = True
+        # One event per run, so a thread from an earlier run still in its
+        # sleep does not carry on once a new run starts
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._run, args=(self._stopped,),
+                                        name='profiler')
+        self._thread.setDaemon(True)
+        self._thread.start()
+
+    def stop(self):
+        self.running = False
+        if self._stopped is not None:
+            self._stopped.set()
+
+    def reset(self):
+        self.counts = collections.defaultdict(int)
+        self.samples = 0
+
+    def _run(self, stopped):
+        while not stopped.isSet():
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is not None:
+                self.counts[self._collapse(frame)] += 1
+                self.samples += 1
+            del frame
+            time.sleep(self.interval)
+
+    def _collapse(self, frame):
+        stack = []
+        while frame is not None:
+            code = frame.f_code
+            stack.append('%s:%s' % (os.path.basename(code.co_filename),
+                                    code.co_name))
+            frame = frame.f_back
+        stack.reverse()
+        return ';'.join(stack)
+
+    def collapsed(self):
+        """
+        The samples so far, one "outer;...;inner count" line per stack.
+        """
+        counts = self.counts.items()
+        counts.sort()
+        return ''.join(['%s %d\n' % (stack, n) for stack, n in counts])
+
+
+class ProfilerResource(resource.Resource):
+    """
+    GET: collapsed stacks so far. POST action=start|stop|reset.
+    """
+    isLeaf = True
+
+    def __init__(self, profiler=None):
+        resource.Resource.__init__(self)
+        if profiler is None:
+            profiler = SamplingProfiler()
+        self.profiler = profiler
+
+    def render_GET(self, request):
+        request.setHeader('content-type', 'text/plain')
+        return self.profiler.collapsed()
+
+    def render_POST(self, request):
+        action = request.args.get('action', [''])[0]
+        if action == 'start':
+            self.profiler.start()
+        elif action == 'stop':
+            self.profiler.stop()
+        elif action == 'reset':
+            self.profiler.reset()
+        else:
+            request.setResponseCode(http.BAD_REQUEST)
+            return 'action must be start, stop or reset\n'
+        request.setHeader('content-type', 'text/plain')
+        return 'profiler %s, %d samples\n' % (
+            self.profiler.running and 'running' or 'stopped',
+            self.profiler.samples)
@@ -0,0 +1,185 @@
+#!/usr/bin/env python
+
+"""
+A local stand-in for the Arduino weather station.
+
+Speaks the same line protocol as the real device: every color line it
+receives is answered with a "tempCts rhCts" line. Response latency,
+jitter, the error rate and the number of concurrent connections are
+configurable, so arduino.Device and the web demo can be load tested
+offline.
+
+$ python emulator.py --port 8080 --latency 0.05 --errors 0.01
+
+and 'python emulator.py --check' makes sure arduino.Device can talk to it.
+
+Errors are, in equal measure: a garbled reply, a dropped connection and
+no reply at all.
+"""
+import sys
+import random
+import logging
+
+from twisted.internet import reactor
+from twisted.internet import protocol
+from twisted.protocols import basic
+from twisted.python import usage
+
+
+class EOptions(usage.Options):
+    optParameters = [
+    ['port', 'p', 8080, 'TCP port to listen on'],
+    ['latency', 'l', 0.0, 'Mean reply latency, seconds'],
+    ['jitter', 'j', 0.0, 'Standard deviation of the reply latency, seconds'],
+    ['errors', 'e', 0.0, 'Fraction of requests that fail'],
+    ['max-connections', 'm', 0, 'Concurrent connection limit, 0 for none'],
+    ]
+    optFlags = [
+    ['check', 'c', 'Make one get_data/set_color round trip and exit'],
+    ]
+
+
+class EmulatorProtocol(basic.LineReceiver):
+    # ArduinoClient ends its requests with '\n' but expects replies to
+    # end with '\r\n', as the sketch's println does
+    delimiter = '\n'
+
+    def connectionMade(self):
+        self.calls = []
+        self.counted = False
+        f = self.factory
+        if f.max_connections and f.active >= f.max_connections:
+            f.stats['refused'] += 1
+            self.transport.loseConnection()
+            return
+        self.counted = True
+        f.active += 1
+        f.stats['connections'] += 1
+
+    def connectionLost(self, reason):
+        if self.counted:
+            self.factory.active -= 1
+        for call in self.calls:
+            if call.active():
+                call.cancel()
+
+    def sendLine(self, line):
+        self.transport.write(line + '\r\n')
+
+    def lineReceived(self, line):
+        f = self.factory
+        f.color = line.strip()
+        f.stats['requests'] += 1
+        delay = max(0.0, random.gauss(f.latency, f.jitter))
+        self.calls = [c for c in self.calls if c.active()]
+        self.calls.append(reactor.callLater(delay, self.reply))
+
+    def reply(self):
+        f = self.factory
+        if random.random() < f.error_rate:
+            f.stats['errors'] += 1
+            failure = random.randint(0, 2)
+            if failure == 0:
+                self.sendLine('garbled')
+            elif failure == 1:
+                self.transport.loseConnection()
+            # else stay silent
+            return
+        self.sendLine('%d %d' % f.reading())
+
+
+class EmulatorFactory(protocol.ServerFactory):
+    protocol = EmulatorProtocol
+
+    def __init__(self, latency=0.0, jitter=0.0, error_rate=0.0,
+                 max_connections=0):
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.max_connections = max_connections
+        self.active = 0
+        self.color = None
+        self.stats = {'connections':0, 'refused':0, 'requests':0, 'errors':0}
+
+    def reading(self):
+        """
+        Raw counts for roughly 25 C and 50 %RH, with a little noise.
+        """
+        return (51 + random.randint(-2, 2), 420 + random.randint(-5, 5))
+
+
+def check():
+    """
+    One get_data and one set_color round trip through arduino.Device
+    against a fresh emulator. Fires with True if both worked.
+    """
+    import arduino
+
+    listener = listen()
+    device = arduino.Device('127.0.0.1', listener.getHost().port,
+                            connect_timeout=5, read_timeout=5)
+    results = []
+
+    def _got_data(reading):
+        results.append(('get_data', reading))
+        return device.set_color(arduino.RED)
+
+    def _set_color(ok):
+        results.append(('set_color', ok))
+
+    def _report(result):
+        for op, value in results:
+            logging.info('%s: %r' % (op, value))
+        logging.info('emulator: %r' % (listener.factory.stats,))
+        listener.stopListening()
+        ok = len(results) == 2 and results[1][1] is True and \
+            listener.factory.color == arduino.RED
+        if not ok:
+            logging.error('Round trip failed: %s' % (result,))
+        return ok
+
+    d = device.get_data()
+    d.addCallback(_got_data)
+    d.addCallback(_set_color)
+    d.addBoth(_report)
+    return d
+
+
+def listen(port=0, **kw):
+    """
+    Start an emulator on port (0 picks a free one); returns the listening
+    port, whose factory attribute holds the stats.
+    """
+    factory = EmulatorFactory(**kw)
+    return reactor.listenTCP(port, factory, interface='127.0.0.1')
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s [%(funcName)s] %(message)s')
+
+    o = EOptions()
+    try:
+        o.parseOptions()
+    except usage.UsageError, errortext:
+        logging.error('%s %s' % (sys.argv[0], errortext))
+        raise SystemExit, 1
+
+    if o.opts['check']:
+        status = []
+
+        def _done(ok):
+            status.append(ok)
+            reactor.stop()
+
+        reactor.callWhenRunning(lambda: check().addCallback(_done))
+        reactor.run()
+        if not status or not status[0]:
+            raise SystemExit, 1
+        raise SystemExit, 0
+
+    listener = listen(int(o.opts['port']), latency=float(o.opts['latency']),
+                      jitter=float(o.opts['jitter']),
+                      error_rate=float(o.opts['errors']),
+                      max_connections=int(o.opts['max-connections']))
+    logging.info('Emulating the arduino on port %d' % listener.getHost().port)
+    reactor.run()
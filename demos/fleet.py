@@ -0,0 +1,121 @@
+#!/usr/bin/env python
+
+"""
+Many arduino.Device stations polled together.
+
+A Fleet keeps a registry of named devices and sweeps them concurrently,
+at most `concurrency` reads at once. Every read has its own timeout, so
+one slow station cannot stall the sweep, and results are handed out as
+they arrive.
+"""
+
+import time
+import bisect
+import logging
+
+from twisted.internet import defer
+from twisted.internet import reactor
+from twisted.python import failure
+
+import arduino
+
+# Upper bounds, in seconds, of the sweep latency histogram buckets
+LATENCY_BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class Fleet(object):
+
+    def __init__(self, concurrency=20, timeout=5.0):
+        self.concurrency = concurrency
+        self.timeout = timeout
+        self.devices = {}
+        self.last_sweep = None
+
+    def add(self, name, device):
+        self.devices[name] = device
+
+    def add_station(self, name, hostname, port=80, **kw):
+        """
+        Register a new arduino.Device for hostname:port.
+        """
+        device = arduino.Device(hostname, port, **kw)
+        self.add(name, device)
+        return device
+
+    def remove(self, name):
+        del self.devices[name]
+
+    def sweep(self, onResult=None):
+        """
+        Read every device once.
+
+        onResult(name, success, result) is called as each read finishes
+        (result is (temp, humidity) or a Failure). The returned Deferred
+        fires with a dict of name: (success, result) when all are done;
+        the sweep's latency histogram is left in last_sweep.
+        """
+        sem = defer.DeferredSemaphore(self.concurrency)
+        stats = {'started':time.time(), 'ok':0, 'failed':0, 'timeouts':0,
+                 'histogram':[0] * (len(LATENCY_BUCKETS) + 1)}
+        results = {}
+
+        def _read(name):
+            started = time.time()
+            d = self._read(self.devices[name])
+            d.addBoth(_done, name, started)
+            return d
+
+        def _done(result, name, started):
+            latency = time.time() - started
+            stats['histogram'][bisect.bisect_left(LATENCY_BUCKETS, latency)] += 1
+            success = not isinstance(result, failure.Failure)
+            if success:
+                stats['ok'] += 1
+            elif result.check(defer.TimeoutError):
+                stats['timeouts'] += 1
+            else:
+                stats['failed'] += 1
+            results[name] = (success, result)
+            if onResult is not None:
+                onResult(name, success, result)
+
+        def _finished(_):
+            stats['duration'] = time.time() - stats['started']
+            self.last_sweep = stats
+            return results
+
+        dl = [sem.run(_read, name) for name in self.devices.keys()]
+        d = defer.DeferredList(dl)
+        d.addCallback(_finished)
+        return d
+
+    def _read(self, device):
+        """
+        device.get_data() that gives up after self.timeout seconds,
+        cancelling the read.
+        """
+        result = defer.Deferred()
+
+        def _expire():
+            result.errback(defer.TimeoutError('no reply from %s:%s in %ss' %
+                                              (device.hostname, device.port,
+                                               self.timeout)))
+            d.cancel()
+
+        def _reply(reply):
+            late = not timer.active()
+            if not late:
+                timer.cancel()
+            if isinstance(reply, failure.Failure):
+                if not late:
+                    result.errback(reply)
+                else:
+                    logging.debug('Late failure from %s: %s' %
+                                  (device.hostname, reply))
+            elif not late:
+                result.callback(reply)
+
+        timer = reactor.callLater(self.timeout, _expire)
+        d = device.get_data()
+        d.addBoth(_reply)
+        return result
@@ -0,0 +1,196 @@
+#!/usr/bin/env python
+
+"""
+In-process sensor history.
+
+Each named series keeps its raw samples and min/max/mean rollups at
+coarser resolutions (1 second and 1 minute by default) in fixed size
+rings of array('d'), allocated up front. Old data falls off the end, so
+memory use does not grow with uptime. Rollups are updated as samples
+arrive, and a range query costs a binary search plus one step per point
+returned.
+
+    h = History()
+    h.record('weather', time.time(), (temp, humidity))
+    h.query('weather', start, end, resolution=60)
+"""
+
+from array import array
+
+# (resolution in seconds, buckets kept): a day of seconds, 30 days of minutes
+LEVELS = ((1, 86400), (60, 43200))
+RAW_CAPACITY = 100000
+
+
+class Ring(object):
+    """
+    A fixed number of rows of `width` floats in one array('d'). The first
+    float of a row is its timestamp, and rows are appended in time order.
+    """
+
+    def __init__(self, capacity, width):
+        self.capacity = capacity
+        self.width = width
+        self.data = array('d', [0.0]) * (capacity * width)
+        self.start = 0
+        self.count = 0
+
+    def __len__(self):
+        return self.count
+
+    def append(self, row):
+        if self.count < self.capacity:
+            i = (self.start + self.count) % self.capacity
+            self.count += 1
+        else:
+            i = self.start
+            self.start = (self.start + 1) % self.capacity
+        offset = i * self.width
+        self.data[offset:offset + self.width] = array('d', row)
+
+    def time(self, i):
+        return self.data[((self.start + i) % self.capacity) * self.width]
+
+    def row(self, i):
+        offset = ((self.start + i) % self.capacity) * self.width
+        return tuple(self.data[offset:offset + self.width])
+
+    def search(self, t):
+        """
+        Index of the first row at or after time t.
+        """
+        lo, hi = 0, self.count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.time(mid) < t:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def between(self, start, end):
+        """
+        Rows with start <= time < end.
+        """
+        rows = []
+        for i in xrange(self.search(start), self.count):
+            row = self.row(i)
+            if row[0] >= end:
+                break
+            rows.append(row)
+        return rows
+
+
+class Rollup(object):
+    """
+    min/max/mean of each field per `resolution` seconds. Rows are
+    (bucket start, min0, max0, mean0, min1, ..., count).
+    """
+
+    def __init__(self, resolution, capacity, fields):
+        self.resolution = resolution
+        self.fields = fields
+        self.ring = Ring(capacity, 2 + 3 * fields)
+        self.bucket = None
+
+    def add(self, t, values):
+        bucket = t - t % self.resolution
+        if bucket != self.bucket:
+            if self.bucket is not None:
+                self.ring.append(self.current())
+            self.bucket = bucket
+            self.mins = list(values)
+            self.maxs = list(values)
+            self.sums = map(float, values)
+            self.count = 1
+            return
+        for i, v in enumerate(values):
+            if v < self.mins[i]:
+                self.mins[i] = v
+            elif v > self.maxs[i]:
+                self.maxs[i] = v
+            self.sums[i] += v
+        self.count += 1
+
+    def current(self):
+        """
+        Row for the bucket still being filled.
+        """
+        row = [self.bucket]
+        for i in xrange(self.fields):
+            row.extend((self.mins[i], self.maxs[i], self.sums[i] / self.count))
+        row.append(self.count)
+        return row
+
+    def between(self, start, end):
+        rows = self.ring.between(start, end)
+        if self.bucket is not None and start <= self.bucket < end:
+            rows.append(tuple(self.current()))
+        return rows
+
+
+class Series(object):
+
+    def __init__(self, fields, raw_capacity=RAW_CAPACITY, levels=LEVELS):
+        self.fields = fields
+        self.raw = Ring(raw_capacity, 1 + fields)
+        self.rollups = [Rollup(resolution, capacity, fields)
+                        for resolution, capacity in levels]
+
+    def add(self, t, values):
+        row = [t]
+        row.extend(values)
+        self.raw.append(row)
+        for rollup in self.rollups:
+            rollup.add(t, values)
+
+    def extend(self, timestamps, values):
+        """
+        Add a block of samples; values is flat, fields floats per sample.
+        """
+        n = self.fields
+        for i, t in enumerate(timestamps):
+            self.add(t, values[i * n:(i + 1) * n])
+
+    def query(self, start, end, resolution=None):
+        """
+        Raw rows (t, v0, v1, ...) when resolution is None, otherwise the
+        rows of the rollup with that resolution.
+        """
+        if resolution is None:
+            return self.raw.between(start, end)
+        for rollup in self.rollups:
+            if rollup.resolution == resolution:
+                return rollup.between(start, end)
+        raise ValueError('no %s second rollup' % (resolution,))
+
+
+class History(object):
+    """
+    Named Series, created on first use with as many fields as the first
+    sample has.
+    """
+
+    def __init__(self, raw_capacity=RAW_CAPACITY, levels=LEVELS):
+        self.raw_capacity = raw_capacity
+        self.levels = levels
+        self.series = {}
+
+    def _series(self, name, fields):
+        series = self.series.get(name)
+        if series is None:
+            series = Series(fields, self.raw_capacity, self.levels)
+            self.series[name] = series
+        return series
+
+    def record(self, name, t, values):
+        self._series(name, len(values)).add(t, values)
+
+    def record_block(self, name, timestamps, values):
+        if not timestamps:
+            return
+        fields = len(values) // len(timestamps)
+        self._series(name, fields).extend(timestamps, values)
+
+    def query(self, name, start, end, resolution=None):
+        return self.series[name].query(start, end, resolution)
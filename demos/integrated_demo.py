@@ -11,17 +11,27 @@ minimizing fanciness and hackyness.
 demonstrate deploying app with tac file
 """
 import os
+import time
+import json
 from string import Template
 
+from twisted.internet import defer
 from twisted.internet import reactor
+from twisted.internet import task
 from twisted.web import resource, static
 from twisted.web import server
+from twisted.web import http
 
 import motion
 import arduino
+import metrics
+import diagnostics
 
 WEB_PORT = 8000
 
+PAGE_REQUESTS = metrics.counter('web_page_requests_total', 'DeviceControlPage GETs')
+PAGE_SECONDS = metrics.histogram('web_page_seconds', 'DeviceControlPage GET time to finish')
+
 staticpath = os.path.join(os.path.abspath('web'), 'static')
 #################################################################
 ## Extra Demonstration Code
@@ -31,26 +41,210 @@ staticpath = os.path.join(os.path.abspath('web'), 'static')
 ## functionality over different network protocols, and or combines different
 ## functionalities.
 
+class TemplateCache(object):
+    """
+    Reads and compiles a template file once, and again only when its
+    modification time changes.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.mtime = None
+        self.template = None
+
+    def get(self):
+        mtime = os.stat(self.path).st_mtime
+        if mtime != self.mtime:
+            f = open(self.path)
+            try:
+                self.template = Template(f.read())
+            finally:
+                f.close()
+            self.mtime = mtime
+        return self.template
+
+
+class CachedFile(static.File):
+    """
+    static.File that sends ETag and Last-Modified headers, answers
+    conditional requests with 304, and keeps files up to max_size bytes
+    in memory until they change on disk. Range requests are left to
+    static.File.
+    """
+    max_size = 64 * 1024
+    # Shared by all the instances static.File creates for children
+    _cache = {}
+
+    def render_GET(self, request):
+        self.restat(False)
+        if not self.exists() or self.isdir() or self.getsize() > self.max_size \
+                or request.getHeader('range') is not None:
+            return static.File.render_GET(self, request)
+
+        mtime = self.getmtime()
+        etag = '"%x-%x"' % (int(mtime), self.getsize())
+        modified = request.setLastModified(mtime)
+        tagged = request.setETag(etag)
+        if http.CACHED in (modified, tagged):
+            return ''
+
+        cached = self._cache.get(self.path)
+        if cached is None or cached[0] != etag:
+            f = self.open()
+            try:
+                cached = (etag, f.read())
+            finally:
+                f.close()
+            self._cache[self.path] = cached
+
+        if self.type is None:
+            self.type, self.encoding = static.getTypeAndEncoding(
+                self.basename(), self.contentTypes, self.contentEncodings,
+                self.defaultType)
+        request.setHeader('content-type', self.type)
+        if self.encoding:
+            request.setHeader('content-encoding', self.encoding)
+        request.setHeader('content-length', str(len(cached[1])))
+        return cached[1]
+
+
+class DevicePoller(object):
+    """
+    Polls a device every interval seconds, keeps the latest reading and
+    passes each new one to the registered listeners. However many
+    clients are watching, the device is read once per interval.
+    """
+
+    def __init__(self, device, interval=5.0):
+        self.device = device
+        self.interval = interval
+        self.latest = None
+        self.listeners = []
+        self.loop = task.LoopingCall(self.poll)
+
+    def start(self):
+        self.loop.start(self.interval)
+
+    def stop(self):
+        if self.loop.running:
+            self.loop.stop()
+
+    def addListener(self, listener):
+        self.listeners.append(listener)
+
+    def removeListener(self, listener):
+        self.listeners.remove(listener)
+
+    def poll(self):
+        d = self.device.get_data()
+        d.addCallback(self._got_data)
+        d.addErrback(self._poll_err)
+        return d
+
+    def _got_data(self, (temp, humidity,)):
+        self.latest = {'temp':temp, 'humidity':humidity,
+                       'color':self.device.color, 'time':time.time()}
+        for listener in self.listeners:
+            listener(self.latest)
+
+    def _poll_err(self, reason):
+        print 'Poll failed'
+        print reason
+
+
+class ReadingResource(resource.Resource):
+    """
+    The latest polled reading as JSON.
+    """
+    isLeaf = True
+
+    def __init__(self, poller):
+        resource.Resource.__init__(self)
+        self.poller = poller
+
+    def render_GET(self, request):
+        request.setHeader('content-type', 'application/json')
+        request.setHeader('cache-control', 'no-cache')
+        if self.poller.latest is None:
+            request.setResponseCode(http.SERVICE_UNAVAILABLE)
+            return json.dumps({'error':'no reading yet'})
+        return json.dumps(self.poller.latest)
+
+
+class ReadingEvents(resource.Resource):
+    """
+    Server-Sent Events stream of readings. Each new reading is encoded
+    once and written to every connected browser.
+    """
+    isLeaf = True
+
+    def __init__(self, poller):
+        resource.Resource.__init__(self)
+        self.poller = poller
+        self.requests = []
+        poller.addListener(self.publish)
+
+    def render_GET(self, request):
+        request.setHeader('content-type', 'text/event-stream')
+        request.setHeader('cache-control', 'no-cache')
+        if self.poller.latest is not None:
+            request.write(self._event(self.poller.latest))
+        self.requests.append(request)
+        request.notifyFinish().addBoth(self._gone, request)
+        return server.NOT_DONE_YET
+
+    def publish(self, reading):
+        event = self._event(reading)
+        for request in self.requests:
+            request.write(event)
+
+    def _event(self, reading):
+        return 'data: %s\n\n' % json.dumps(reading)
+
+    def _gone(self, result, request):
+        self.requests.remove(request)
+
+
 class DeviceControlPage(resource.Resource):
 
-    def __init__(self, device):
+    def __init__(self, device, poller=None):
+        """
+        With a DevicePoller the page renders from its latest reading and
+        also serves it as JSON (/reading) and as an event stream (/events).
+        """
         resource.Resource.__init__(self)
         self.staticroot = staticpath
         self.device = device
+        self.poller = poller
+        self.index = TemplateCache(os.path.join(self.staticroot, "index.html"))
         self.putChild('demo', self)
-        self.putChild('static', static.File(self.staticroot))
+        self.putChild('static', CachedFile(self.staticroot))
+        self.putChild('metrics', metrics.MetricsResource())
+        self.putChild('profile', diagnostics.ProfilerResource())
+        if poller is not None:
+            self.putChild('reading', ReadingResource(poller))
+            self.putChild('events', ReadingEvents(poller))
 
     def render_GET(self, request):
         """
         """
+        PAGE_REQUESTS.inc()
+        started = time.time()
+        request.notifyFinish().addBoth(
+            lambda _: PAGE_SECONDS.observe(time.time() - started))
+        if self.poller is not None and self.poller.latest is not None:
+            latest = self.poller.latest
+            self._get_index((latest['temp'], latest['humidity'],), request)
+            return server.NOT_DONE_YET
         d = self.device.get_data()
         d.addCallback(self._get_index, request)
-        d.addErrback(self._err_get)
+        d.addErrback(self._err_get, request)
+        # A client that hangs up cancels its read, and its connection closes
+        request.notifyFinish().addErrback(lambda _: d.cancel())
         return server.NOT_DONE_YET
 
     def _get_index(self, (temp, humidity,), request):
-        tmpl = os.path.join(self.staticroot, "index.html")
-        html = Template(open(tmpl).read()).substitute({'dcolor':self.device.color, 'temp':str(temp), 'hum':str(humidity)})
+        html = self.index.get().substitute({'dcolor':self.device.color, 'temp':str(temp), 'hum':str(humidity)})
         request.write(html)
         request.finish()
 
@@ -77,9 +271,15 @@ class DeviceControlPage(resource.Resource):
         """ % (self.device.color, temp, humidity,))
         request.finish()
 
-    def _err_get(self, reason):
-        print 'ERR'
-        print reason
+    def _err_get(self, reason, request):
+        if reason.check(defer.CancelledError):
+            # The client has gone, there is no one to answer
+            return
+        print 'No reading for %s: %s' % (request.uri, reason.getErrorMessage())
+        request.setResponseCode(http.SERVICE_UNAVAILABLE)
+        request.setHeader('content-type', 'text/plain')
+        request.write('The weather station is not answering: %s\n' % (reason.getErrorMessage(),))
+        request.finish()
 
 
     def render_POST(self, request):
@@ -98,10 +298,16 @@ def test_web():
 class MotionToLight(motion.MotionProcessProtocol):
 
     def __init__(self, device):
+        motion.MotionProcessProtocol.__init__(self)
         self.device = device
+        self.scheduler = arduino.ColorScheduler(device)
 
     def motionReceived(self, motion):
-        self.device.set_colorRGB(*map(int, motion))
+        self.scheduler.set_colorRGB(*map(int, motion))
+
+    def motionBatchReceived(self, timestamps, xyz):
+        # Only the newest color of a block would survive the scheduler
+        self.motionReceived(xyz[-3:])
 
 
 #######################################################
@@ -170,9 +376,23 @@ def demo2():
     Run this demo and use a web browser to view:
     http://localhost:8000/demo
 
+    The device is polled once every few seconds no matter how many
+    browsers are connected. The latest reading is also available as JSON
+    at http://localhost:8000/reading and as a stream of Server-Sent
+    Events at http://localhost:8000/events
+
+    Counters and latency histograms for the device, the motion pipeline
+    and this page are at http://localhost:8000/metrics, along with how
+    late the reactor runs scheduled calls (reactor_lag_seconds).
+    http://localhost:8000/profile samples the reactor thread's stack; see
+    diagnostics.py.
+
     """
     device = arduino.Device()
-    site = server.Site(DeviceControlPage(device))
+    poller = DevicePoller(device)
+    poller.start()
+    diagnostics.LagMonitor().start()
+    site = server.Site(DeviceControlPage(device, poller))
     port = reactor.listenTCP(WEB_PORT, site)
 
 def demo3():
@@ -202,8 +422,9 @@ def demo4():
     the ability to change the LED color by moving your laptop around.
 
     The MotionToLight extends the MotionProcessProtocol. The motionReceived
-    event handler calls the set_color method of the arduino device every
-    time it gets a new accelerometer sample.
+    event handler hands every accelerometer sample to an
+    arduino.ColorScheduler, which keeps one set_color call in flight and
+    only sends the newest color once the device has answered.
 
     """
     device = arduino.Device()
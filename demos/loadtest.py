@@ -0,0 +1,156 @@
+#!/usr/bin/env python
+
+"""
+Load test arduino.Device against the local emulator.
+
+Starts an emulator in process, fires --requests get_data or set_color
+calls with up to --concurrency in flight, and reports throughput and
+p50/p99 latency.
+
+$ python loadtest.py --requests 10000 --concurrency 2000 --pool 20
+
+Note that get_data() coalesces concurrent calls, so the emulator sees
+far fewer reads than there are calls; set_color always makes a request.
+--separate gives every concurrency slot a Device of its own (sharing one
+pool), so each get_data call really is a device read:
+
+$ python loadtest.py --requests 10000 --concurrency 2000 --separate
+Thousands of concurrent connections may need a higher 'ulimit -n'.
+"""
+import sys
+import time
+import logging
+
+from twisted.internet import defer
+from twisted.internet import reactor
+from twisted.python import usage
+
+import arduino
+import emulator
+
+
+class LOptions(usage.Options):
+    optParameters = [
+    ['requests', 'n', 10000, 'Number of calls to make'],
+    ['concurrency', 'c', 1000, 'Calls in flight at once'],
+    ['op', 'o', 'get_data', 'get_data or set_color'],
+    ['pool', 'p', 0, 'Device pool_size, 0 for a connection per call'],
+    ['latency', 'l', 0.0, 'Emulator mean latency, seconds'],
+    ['jitter', 'j', 0.0, 'Emulator latency jitter, seconds'],
+    ['errors', 'e', 0.0, 'Emulator error rate'],
+    ]
+    optFlags = [
+    ['separate', 's', 'One Device per concurrency slot, so get_data calls are not coalesced'],
+    ]
+
+
+def percentile(ordered, p):
+    if not ordered:
+        return None
+    return ordered[min(len(ordered) - 1, int(len(ordered) * p))]
+
+
+def run(device, requests, concurrency, op='get_data'):
+    """
+    Make requests calls of device.<op> with at most concurrency in
+    flight. Fires with a dict of results.
+
+    device may also be a list of at least concurrency Devices; each call
+    then gets a Device no other call in flight is using.
+    """
+    sem = defer.DeferredSemaphore(concurrency)
+    latencies = []
+    errors = [0]
+    if isinstance(device, list):
+        free = list(device)
+    else:
+        free = [device] * concurrency
+
+    def _call():
+        started = time.time()
+        dev = free.pop()
+        if op == 'set_color':
+            d = dev.set_color(arduino.WHITE)
+        else:
+            d = dev.get_data()
+        d.addCallbacks(_ok, _err, callbackArgs=(started,))
+        d.addBoth(_free, dev)
+        return d
+
+    def _free(result, dev):
+        free.append(dev)
+        return result
+
+    def _ok(result, started):
+        # set_color reports failure as False rather than an errback
+        if result is False:
+            errors[0] += 1
+        else:
+            latencies.append(time.time() - started)
+
+    def _err(reason):
+        errors[0] += 1
+
+    def _report(_):
+        elapsed = time.time() - started
+        latencies.sort()
+        return {'op':op, 'requests':requests, 'concurrency':concurrency,
+                'elapsed':elapsed, 'throughput':requests / elapsed,
+                'errors':errors[0],
+                'p50':percentile(latencies, 0.50),
+                'p99':percentile(latencies, 0.99)}
+
+    started = time.time()
+    d = defer.DeferredList([sem.run(_call) for i in xrange(requests)])
+    d.addCallback(_report)
+    return d
+
+
+def main(o):
+    listener = emulator.listen(latency=float(o.opts['latency']),
+                               jitter=float(o.opts['jitter']),
+                               error_rate=float(o.opts['errors']))
+    port = listener.getHost().port
+    device = arduino.Device('127.0.0.1', port, pool_size=int(o.opts['pool']))
+    target = device
+    if o.opts['separate']:
+        target = []
+        for i in xrange(int(o.opts['concurrency'])):
+            slot = arduino.Device('127.0.0.1', port)
+            slot.pool = device.pool
+            target.append(slot)
+
+    def _print(report):
+        for k in ('op', 'requests', 'concurrency', 'elapsed', 'throughput',
+                  'errors', 'p50', 'p99'):
+            print '%-12s %s' % (k, report[k])
+        if isinstance(target, list):
+            stats = {}
+            for slot in target:
+                for k, v in slot.stats.items():
+                    stats[k] = stats.get(k, 0) + v
+            print 'devices     ', stats
+        else:
+            print 'device      ', device.stats
+        if device.pool is not None:
+            print 'pool        ', device.pool.stats
+        print 'emulator    ', listener.factory.stats
+
+    d = run(target, int(o.opts['requests']), int(o.opts['concurrency']),
+            o.opts['op'])
+    d.addCallback(_print)
+    d.addBoth(lambda _: reactor.stop())
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.WARNING)
+
+    o = LOptions()
+    try:
+        o.parseOptions()
+    except usage.UsageError, errortext:
+        logging.error('%s %s' % (sys.argv[0], errortext))
+        raise SystemExit, 1
+
+    reactor.callWhenRunning(main, o)
+    reactor.run()
@@ -0,0 +1,157 @@
+#!/usr/bin/env python
+
+"""
+Counters, gauges and histograms, and a /metrics page that shows them in
+the Prometheus text format.
+
+Everything runs on the reactor thread, so an update is a plain attribute
+change: no locks, and well under a microsecond (run this module to see
+the cost on your machine).
+
+    REQUESTS = metrics.counter('web_requests_total', 'Pages rendered')
+    REQUESTS.inc()
+
+    site = server.Site(root)
+    root.putChild('metrics', metrics.MetricsResource())
+"""
+import bisect
+import timeit
+
+from twisted.web import resource
+
+# Latency buckets, seconds
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0,
+                   2.5, 5.0, 10.0)
+
+
+class Counter(object):
+    __slots__ = ('name', 'help', 'value')
+    kind = 'counter'
+
+    def __init__(self, name, help):
+        self.name = name
+        self.help = help
+        self.value = 0
+
+    def inc(self, n=1):
+        self.value += n
+
+    def samples(self):
+        return [(self.name, self.value)]
+
+
+class Gauge(Counter):
+    __slots__ = ()
+    kind = 'gauge'
+
+    def set(self, value):
+        self.value = value
+
+    def dec(self, n=1):
+        self.value -= n
+
+
+class Histogram(object):
+    __slots__ = ('name', 'help', 'buckets', 'counts', 'sum', 'count')
+    kind = 'histogram'
+
+    def __init__(self, name, help, buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help
+        self.buckets = tuple(buckets)
+        # One more than buckets, for +Inf
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def samples(self):
+        samples = []
+        total = 0
+        for bound, n in zip(self.buckets, self.counts):
+            total += n
+            samples.append(('%s_bucket{le="%s"}' % (self.name, bound), total))
+        samples.append(('%s_bucket{le="+Inf"}' % self.name, self.count))
+        samples.append(('%s_sum' % self.name, self.sum))
+        samples.append(('%s_count' % self.name, self.count))
+        return samples
+
+
+class Registry(object):
+
+    def __init__(self):
+        self.metrics = {}
+
+    def _get(self, cls, name, help, *args):
+        metric = self.metrics.get(name)
+        if metric is None:
+            metric = self.metrics[name] = cls(name, help, *args)
+        elif type(metric) is not cls:
+            raise ValueError('%s is already a %s' % (name, metric.kind))
+        return metric
+
+    def counter(self, name, help=''):
+        return self._get(Counter, name, help)
+
+    def gauge(self, name, help=''):
+        return self._get(Gauge, name, help)
+
+    def histogram(self, name, help='', buckets=DEFAULT_BUCKETS):
+        return self._get(Histogram, name, help, buckets)
+
+    def render(self):
+        lines = []
+        for name in sorted(self.metrics):
+            metric = self.metrics[name]
+            if metric.help:
+                lines.append('# HELP %s %s' % (name, metric.help))
+            lines.append('# TYPE %s %s' % (name, metric.kind))
+            for sample, value in metric.samples():
+                lines.append('%s %s' % (sample, value))
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()
+counter = REGISTRY.counter
+gauge = REGISTRY.gauge
+histogram = REGISTRY.histogram
+
+
+class MetricsResource(resource.Resource):
+    isLeaf = True
+
+    def __init__(self, registry=REGISTRY):
+        resource.Resource.__init__(self)
+        self.registry = registry
+
+    def render_GET(self, request):
+        request.setHeader('content-type', 'text/plain; version=0.0.4')
+        return self.registry.render()
+
+
+def overhead(number=1000000):
+    """
+    Seconds per update for each metric type.
+    """
+    r = Registry()
+    c = r.counter('c')
+    g = r.gauge('g')
+    h = r.histogram('h')
+    results = {}
+    for name, stmt in (('counter.inc', c.inc), ('gauge.set', lambda: g.set(1)),
+                       ('histogram.observe', lambda: h.observe(0.03))):
+        results[name] = min(timeit.repeat(stmt, number=number, repeat=3)) / number
+    # The lambdas add a call of their own; take it off
+    empty = min(timeit.repeat(lambda: None, number=number, repeat=3)) / number
+    results['gauge.set'] -= empty
+    results['histogram.observe'] -= empty
+    return results
+
+
+if __name__ == '__main__':
+    for name, seconds in sorted(overhead().items()):
+        print '%-18s %6.0f ns' % (name, seconds * 1e9)
@@ -11,34 +11,249 @@
 
 @note Run 'nc -l 9997' in another window to provide a TCP server and display.
 '''
-from twisted.internet import reactor, protocol
+from twisted.internet import reactor, protocol, task, interfaces, defer, error
 from twisted.internet.protocol import DatagramProtocol
 from twisted.internet.endpoints import TCP4ClientEndpoint
-from twisted.python import usage
+from twisted.python import usage, failure
+from zope.interface import implements
 
+from array import array
+import collections
+import cPickle
 import logging as log
+import random
+import struct
 import sys
 import time
 
+import metrics
+
+MOTION_BYTES = metrics.counter('motion_bytes_total', 'Bytes read from the motion process')
+MOTION_SAMPLES = metrics.counter('motion_samples_total', 'Motion samples parsed')
+MOTION_MALFORMED = metrics.counter('motion_malformed_total', 'Motion lines that did not parse')
+GRAPHITE_BYTES = metrics.counter('graphite_bytes_total', 'Bytes written to Graphite')
+GRAPHITE_WRITES = metrics.counter('graphite_writes_total', 'Writes to the Graphite transport')
+STATSD_BYTES = metrics.counter('statsd_bytes_total', 'Bytes sent to statsd')
+STATSD_DATAGRAMS = metrics.counter('statsd_datagrams_total', 'Datagrams sent to statsd')
+
+SINK_POLICIES = ('drop_oldest', 'drop_newest', 'latest')
+
 # Command line flags and associated default values
 class MOptions(usage.Options):
     optParameters = [
     ['port', 'p', 9997, 'Destination TCP port for data stream'],
     ['host', 'h', 'localhost', 'Destination hostname or IP'],
     ['interval', 'i', 100, 'Polling interval, milliseconds'],
+    ['source', 's', 'motion', "Sample source: 'motion', 'sim', or a file of motion output to replay"],
+    ['rate', 'r', 0, 'Samples per second for sim or replay, 0 to match interval'],
+    ['sinks', None, 'statsd', 'Comma separated sinks to feed: graphite, statsd, raw, led'],
+    ['graphite', 'g', 'localhost:2003', 'Graphite host:port for the graphite sink'],
+    ['statsd', None, '127.0.0.1:8125', 'statsd host:port for the statsd sink'],
+    ['mtu', 'm', 0, 'Pack statsd metrics into datagrams of up to this many bytes, 0 for one per datagram'],
+    ['prefix', None, None, 'Metric path prefix for graphite and statsd (default paul.accel)'],
     ]
 
-class GraphiteSender(protocol.Protocol):
-    def sendMessage(self, msg):
+class StreamSender(protocol.Protocol):
+    """
+    Base for the protocols TCPProducingClient streams samples over.
+
+    closed fires with the reason when the connection goes away. The
+    sender registers as a streaming producer on its transport, so paused
+    is True while the peer is not keeping up; whenWritable() fires once
+    it is not (or the connection is gone). Everyone waiting on the same
+    pause shares one Deferred, so callbacks added to it should pass the
+    result on.
+    """
+    implements(interfaces.IPushProducer)
+
+    def connectionMade(self):
+        self.closed = defer.Deferred()
+        self.paused = False
+        self._writable = None
+        self.transport.registerProducer(self, True)
+
+    def connectionLost(self, reason):
+        self._fireWritable()
+        self.closed.callback(reason)
+
+    def whenWritable(self):
+        if not self.paused:
+            return defer.succeed(None)
+        if self._writable is None:
+            self._writable = defer.Deferred()
+        return self._writable
+
+    def _fireWritable(self):
+        d, self._writable = self._writable, None
+        if d is not None:
+            d.callback(None)
+
+    def pauseProducing(self):
+        self.paused = True
+
+    def resumeProducing(self):
+        self.paused = False
+        self._fireWritable()
+
+    def stopProducing(self):
+        self.paused = True
+
+class GraphiteSender(StreamSender):
+    # Metric paths are <prefix>.x, <prefix>.y and <prefix>.z
+    prefix = 'paul.accel'
+
+    def formatLines(self, msg, now):
         # Assuming that msg is an 3-array of floats, x-z
-        now = int(time.time())
-        lines = []
-        lines.append('paul.accel.x %s %d' % (msg[0], now))
-        lines.append('paul.accel.y %s %d' % (msg[1], now))
-        lines.append('paul.accel.z %s %d' % (msg[2], now))
-        message = '\n'.join(lines) + '\n' #all lines must end in a newline
+        #all lines must end in a newline
+        return ('%s.x %s %d\n' % (self.prefix, msg[0], now),
+                '%s.y %s %d\n' % (self.prefix, msg[1], now),
+                '%s.z %s %d\n' % (self.prefix, msg[2], now))
+
+    def sendMessage(self, msg, now=None):
+        if now is None:
+            now = time.time()
+        message = ''.join(self.formatLines(msg, int(now)))
 
         log.debug('sending packet')
+        GRAPHITE_WRITES.inc()
+        GRAPHITE_BYTES.inc(len(message))
+        self.transport.write(message)
+
+class BufferedGraphiteSender(GraphiteSender):
+    """
+    GraphiteSender that collects lines and writes them in large chunks,
+    either when max_lines are buffered or every flush_interval seconds.
+
+    While the transport is paused, flushed chunks wait in a queue of at most
+    max_queued entries; past that, the oldest chunk (or, with
+    drop_oldest False, the newest) is dropped.
+
+    Lines not yet written when the connection is lost count as drops,
+    and their samples are left in unsent as (time, motion) pairs, which
+    TCPProducingClient puts back in its backlog.
+    """
+    max_lines = 300
+    flush_interval = 1.0
+    max_queued = 100
+    drop_oldest = True
+
+    def connectionMade(self):
+        GraphiteSender.connectionMade(self)
+        self.lines = []
+        self.samples = []
+        self.unsent = []
+        self.queue = collections.deque()
+        self.stats = {'bytes':0, 'flushes':0, 'drops':0}
+        self.flusher = task.LoopingCall(self.flush)
+        self.flusher.start(self.flush_interval, now=False)
+
+    def connectionLost(self, reason):
+        if self.flusher.running:
+            self.flusher.stop()
+        unsent = []
+        for chunk, samples in self.queue:
+            unsent.extend(samples)
+        unsent.extend(self.samples)
+        self.queue.clear()
+        del self.lines[:]
+        self.samples = []
+        self.unsent = unsent
+        if unsent:
+            self.stats['drops'] += 3 * len(unsent)
+            log.debug('connection lost with %d samples unsent' % len(unsent))
+        GraphiteSender.connectionLost(self, reason)
+
+    def sendMessage(self, msg, now=None):
+        if now is None:
+            now = time.time()
+        self.samples.append((now, msg))
+        self.lines.extend(self.formatLines(msg, int(now)))
+        if len(self.lines) >= self.max_lines:
+            self.flush()
+
+    def flush(self):
+        if self.lines:
+            self.queue.append((''.join(self.lines), self.samples))
+            del self.lines[:]
+            self.samples = []
+            if len(self.queue) > self.max_queued:
+                if self.drop_oldest:
+                    chunk, samples = self.queue.popleft()
+                else:
+                    chunk, samples = self.queue.pop()
+                self.stats['drops'] += 3 * len(samples)
+                log.debug('transport backed up, dropped %d lines' % (3 * len(samples)))
+        self._drain()
+
+    def _drain(self):
+        while self.queue and not self.paused:
+            chunk, samples = self.queue.popleft()
+            self.stats['bytes'] += len(chunk)
+            self.stats['flushes'] += 1
+            GRAPHITE_WRITES.inc()
+            GRAPHITE_BYTES.inc(len(chunk))
+            self.transport.write(chunk)
+
+    def resumeProducing(self):
+        self.paused = False
+        self._drain()
+        GraphiteSender.resumeProducing(self)
+
+class PickleGraphiteSender(GraphiteSender):
+    """
+    Speaks Carbon's pickle protocol (port 2004 by default) instead of
+    lines. Each message is a 4 byte big-endian length followed by a
+    pickled list of (path, (timestamp, value)) tuples.
+
+    Samples are batched until max_batch of them are waiting or the
+    oldest has waited max_age seconds.
+    """
+    max_batch = 500
+    max_age = 1.0
+
+    def connectionMade(self):
+        GraphiteSender.connectionMade(self)
+        self.batch = []
+        self._timer = None
+        self._paths = (None, None)
+
+    def connectionLost(self, reason):
+        if self._timer is not None and self._timer.active():
+            self._timer.cancel()
+        self._timer = None
+        GraphiteSender.connectionLost(self, reason)
+
+    def paths(self):
+        prefix, paths = self._paths
+        if prefix != self.prefix:
+            paths = ('%s.x' % self.prefix, '%s.y' % self.prefix,
+                     '%s.z' % self.prefix)
+            self._paths = (self.prefix, paths)
+        return paths
+
+    def sendMessage(self, msg, now=None):
+        if now is None:
+            now = time.time()
+        now = int(now)
+        x, y, z = self.paths()
+        self.batch.extend(((x, (now, msg[0])), (y, (now, msg[1])),
+                           (z, (now, msg[2]))))
+        if len(self.batch) >= 3 * self.max_batch:
+            self.flush()
+        elif self._timer is None:
+            self._timer = reactor.callLater(self.max_age, self.flush)
+
+    def flush(self):
+        if self._timer is not None and self._timer.active():
+            self._timer.cancel()
+        self._timer = None
+        if not self.batch:
+            return
+        payload = cPickle.dumps(self.batch, 2)
+        self.batch = []
+        message = struct.pack('!L', len(payload)) + payload
+        GRAPHITE_WRITES.inc()
+        GRAPHITE_BYTES.inc(len(message))
         self.transport.write(message)
 
 class StatsdSender(DatagramProtocol):
@@ -46,23 +261,72 @@ class StatsdSender(DatagramProtocol):
     @see http://twistedmatrix.com/documents/current/core/examples/echoclient_udp.py
     This sends the data out over UDP to the Etsy node.js based stats daemon.
     Slightly different wire protocol.
+
+    With mtu set, metrics are packed newline separated into datagrams of
+    up to mtu bytes, sent when the next metric would not fit or every
+    flush_interval seconds. With mtu 0 each metric is its own datagram.
     """
+    def __init__(self, host='127.0.0.1', port=8125, prefix='paul.accel',
+                 mtu=0, flush_interval=0.5):
+        self.host = host
+        self.port = port
+        self.prefix = prefix
+        self.mtu = mtu
+        self.flush_interval = flush_interval
+        self.packet = []
+        self.packet_size = 0
+        self.flusher = None
+
     def startProtocol(self):
-        # @bug Add init, save address, connect to that
         log.debug('Connecting udp')
-        self.transport.connect('127.0.0.1', 8125)
+        self.transport.connect(self.host, self.port)
         log.debug('udp done')
+        if self.mtu:
+            self.flusher = task.LoopingCall(self.flush)
+            self.flusher.start(self.flush_interval, now=False)
+
+    def stopProtocol(self):
+        if self.flusher is not None and self.flusher.running:
+            self.flusher.stop()
+        # The transport is gone by now; call flush() before stopListening
+        if self.packet:
+            log.debug('dropping %d unsent metrics' % len(self.packet))
+            del self.packet[:]
+            self.packet_size = 0
 
     def connectionRefused(self):
         log.error('connection refused!')
 
     def sendDatagram(self, msg):
         # Assuming that msg is an 3-array of floats, x-z
-        self.transport.write('paul.accel.x:%s|c' % msg[0])
-        self.transport.write('paul.accel.y:%s|c' % msg[1])
-        self.transport.write('paul.accel.z:%s|c' % msg[2])
+        lines = ('%s.x:%s|c' % (self.prefix, msg[0]),
+                 '%s.y:%s|c' % (self.prefix, msg[1]),
+                 '%s.z:%s|c' % (self.prefix, msg[2]))
+        if not self.mtu:
+            for metric in lines:
+                STATSD_DATAGRAMS.inc()
+                STATSD_BYTES.inc(len(metric))
+                self.transport.write(metric)
+            return
 
-class Sender(protocol.Protocol):
+        for metric in lines:
+            # +1 for the newline that separates it from the previous one
+            if self.packet and self.packet_size + len(metric) + 1 > self.mtu:
+                self.flush()
+            self.packet.append(metric)
+            self.packet_size += len(metric) + 1
+
+    def flush(self):
+        if not self.packet:
+            return
+        packet = '\n'.join(self.packet)
+        STATSD_DATAGRAMS.inc()
+        STATSD_BYTES.inc(len(packet))
+        self.transport.write(packet)
+        del self.packet[:]
+        self.packet_size = 0
+
+class Sender(StreamSender):
     """
     This handles sending the data to the TCP server.
     """
@@ -71,7 +335,7 @@ class Sender(protocol.Protocol):
         self.transport.write(msg)
         self.transport.write('\n')
 
-    def sendMessage(self, msg):
+    def sendMessage(self, msg, now=None):
         if len(msg) != 3:
             return
         outbound_msg = 'x: %f y: %f z: %f\n' % (msg[0], msg[1], msg[2])
@@ -81,17 +345,140 @@ class MotionProcessProtocol(protocol.ProcessProtocol):
     """
     A Python wrapper (twisted protocol) around the monitor program.
     """
+    # Longest partial line we hold on to between reads
+    MAX_LENGTH = 1024
+    # Samples per motionBatchReceived call; 0 delivers every read as is
+    block_size = 0
+    # Longest time, in seconds, a sample waits for its block to fill
+    max_latency = 0.1
+    # A history.History to record every sample in, under 'motion'
+    history = None
+    # A three field samplelog.SampleLog to write every sample to
+    samplelog = None
+
+    def __init__(self):
+        self._initState()
+
+    def _initState(self):
+        self._buffer = bytearray()
+        self._timestamps = array('d')
+        self._xyz = array('d')
+        self._flush_call = None
+        self.stats = {'lines':0, 'malformed':0, 'dropped':0}
+
+    def makeConnection(self, transport):
+        # Subclasses with an __init__ of their own may not call ours
+        if getattr(self, '_buffer', None) is None:
+            self._initState()
+        protocol.ProcessProtocol.makeConnection(self, transport)
 
     def outReceived(self, data):
         """
         This is called when the motion app prints out data. Format is 3 floats, string
         format, with a space inbetween. easy to parse.
+
+        A read can hold several lines, or end part way through one, so
+        only complete lines are parsed; the rest waits for the next read.
+        """
+        MOTION_BYTES.inc(len(data))
+        buf = self._buffer
+        buf.extend(data)
+        end = buf.rfind('\n')
+        if end < 0:
+            if len(buf) > self.MAX_LENGTH:
+                log.debug('No newline in %d bytes, dropping' % len(buf))
+                self.stats['dropped'] += 1
+                del buf[:]
+            return
+        chunk = str(buf[:end])
+        del buf[:end + 1]
+
+        xyz = self.parseChunk(chunk)
+        if xyz:
+            self.motionArrayReceived(xyz)
+
+    def parseChunk(self, chunk):
+        """
+        Parse a block of complete lines into a flat array('d') of x, y, z
+        triples, skipping (and counting) malformed lines.
+        """
+        tokens = []
+        for line in chunk.split('\n'):
+            values = line.split()
+            if len(values) == 3:
+                tokens.extend(values)
+            elif values:
+                log.debug('Only got %d values, skipping' % len(values))
+                self.stats['malformed'] += 1
+                MOTION_MALFORMED.inc()
+        try:
+            xyz = array('d', map(float, tokens))
+        except ValueError:
+            # Slow path, find the lines that do not parse
+            xyz = array('d')
+            for i in xrange(0, len(tokens), 3):
+                try:
+                    xyz.extend(map(float, tokens[i:i + 3]))
+                except ValueError:
+                    self.stats['malformed'] += 1
+                    MOTION_MALFORMED.inc()
+        self.stats['lines'] += len(xyz) / 3
+        MOTION_SAMPLES.inc(len(xyz) / 3)
+        return xyz
+
+    def motionArrayReceived(self, xyz):
+        """
+        Called with every parsed read, a flat array('d') of x, y, z
+        triples. Stamps the samples and collects them into blocks for
+        motionBatchReceived.
+        """
+        timestamps = array('d', [time.time()]) * (len(xyz) / 3)
+        if self.history is not None:
+            self.history.record_block('motion', timestamps, xyz)
+        if self.samplelog is not None:
+            self.samplelog.append_block(timestamps, xyz)
+        if not self.block_size:
+            self.motionBatchReceived(timestamps, xyz)
+            return
+
+        self._timestamps.extend(timestamps)
+        self._xyz.extend(xyz)
+        if len(self._timestamps) >= self.block_size:
+            self.flushBatch()
+        elif self._flush_call is None:
+            self._flush_call = reactor.callLater(self.max_latency,
+                                                 self.flushBatch)
+
+    def flushBatch(self):
+        """
+        Deliver whatever samples are waiting for their block to fill.
         """
-        motion = map(float, data.strip().split())
-        if len(motion) != 3:
-            log.debug('Only got %d values, skipping' % len(motion))
+        if self._flush_call is not None:
+            if self._flush_call.active():
+                self._flush_call.cancel()
+            self._flush_call = None
+        if not self._timestamps:
             return
-        self.motionReceived(motion)
+        timestamps, xyz = self._timestamps, self._xyz
+        self._timestamps = array('d')
+        self._xyz = array('d')
+        self.motionBatchReceived(timestamps, xyz)
+
+    def processEnded(self, reason):
+        self.flushBatch()
+
+    def motionBatchReceived(self, timestamps, xyz):
+        """
+        Implement this event handler to consume samples a block at a time.
+
+        @param timestamps array('d') of sample times, seconds since epoch
+        @param xyz array('d') of x, y, z triples, 3 * len(timestamps) long.
+        numpy.frombuffer(xyz).reshape(-1, 3) views it without copying.
+
+        The default calls motionReceived once per sample.
+        """
+        for i in xrange(0, len(xyz), 3):
+            self.motionReceived(xyz[i:i + 3].tolist())
 
     def motionReceived(self, motion):
         """
@@ -99,17 +486,32 @@ class MotionProcessProtocol(protocol.ProcessProtocol):
 
         @param motion tupple of force values (x,y,z)
         """
-        log.info('got "%s"' % str(motion))
+        log.info('got "%s"', motion)
 
 class UDPProducingClient(MotionProcessProtocol):
-    #def __init__(self, hostname, portnum):
-    #    self.hostname = hostname
-    #    self.portnum = int(portnum)
+    """
+    Streams the samples to statsd. Pass mtu (e.g. 1432) to pack many
+    metrics into each datagram.
+    """
+    def __init__(self, hostname='127.0.0.1', portnum=8125, mtu=0,
+                 prefix='paul.accel'):
+        MotionProcessProtocol.__init__(self)
+        self.hostname = hostname
+        self.portnum = int(portnum)
+        self.mtu = int(mtu)
+        self.prefix = prefix
 
     def connectionMade(self):
-        self.ss = StatsdSender()
+        self.ss = StatsdSender(self.hostname, self.portnum, self.prefix,
+                               mtu=self.mtu)
         self.sd = reactor.listenUDP(0, self.ss)
 
+    def processEnded(self, reason):
+        MotionProcessProtocol.processEnded(self, reason)
+        # Send the last packed datagram while the port is still open
+        self.ss.flush()
+        self.sd.stopListening()
+
     def motionReceived(self, motion):
         self.ss.sendDatagram(motion)
 
@@ -121,11 +523,56 @@ class TCPProducingClient(MotionProcessProtocol):
     nc -l 9997
 
     or, if you have LabVIEW, the 'LV Client.vi' for a live data viewer.
+
+    Set senderProtocol to BufferedGraphiteSender to batch the writes, or
+    to PickleGraphiteSender (and the port to 2004) for Carbon's pickle
+    protocol. prefix, if given, replaces the sender's metric prefix.
+
+    Only one connection attempt is made at a time. Failed attempts and
+    lost connections are retried after a delay that doubles up to
+    max_delay, with +/- jitter. Samples that arrive while disconnected,
+    or while the sender is paused, are kept, up to max_backlog of them,
+    and replayed on reconnect or resume.
+
+    motionBatchReceived returns a Deferred while the connection is down
+    or the sender is paused, which fires once it can take more; under a
+    MotionHub, samples then wait in the sink's queue. processEnded closes
+    the outbound connection for good.
     """
+    senderProtocol = GraphiteSender
+
+    initial_delay = 1.0
+    max_delay = 60.0
+    factor = 2.0
+    jitter = 0.1
+    # An hour of samples at the default 100ms interval
+    max_backlog = 36000
 
-    def __init__(self, hostname, portnum):
+    def __init__(self, hostname, portnum, prefix=None):
+        MotionProcessProtocol.__init__(self)
         self.hostname = hostname
         self.portnum = int(portnum)
+        self.prefix = prefix
+        self.p = None
+        self.state = 'disconnected'
+        self.delay = self.initial_delay
+        self.backlog = collections.deque(maxlen=self.max_backlog)
+        self._retry_call = None
+        # Fires on the next connect, shared by everyone waiting for it
+        self._connected = None
+        # The sender replay is waiting on to resume
+        self._replay_wait = None
+        self.stats.update({'connects':0, 'attempts':0, 'disconnects':0,
+                           'overflow':0, 'replayed':0, 'recovered':0})
+
+    def metrics(self):
+        """
+        Outbound connection state and backlog depth, plus stats.
+        """
+        m = dict(self.stats)
+        m.update({'state':self.state, 'backlog':len(self.backlog),
+                  'delay':self.delay})
+        return m
 
     def connectionMade(self):
         """
@@ -134,39 +581,320 @@ class TCPProducingClient(MotionProcessProtocol):
         """
         self.open_outbound()
 
+    def processEnded(self, reason):
+        MotionProcessProtocol.processEnded(self, reason)
+        self.state = 'stopped'
+        if self._retry_call is not None and self._retry_call.active():
+            self._retry_call.cancel()
+        self._retry_call = None
+        if self.p is not None:
+            if self.p.paused:
+                # The peer is not reading, so a clean close would wait on
+                # it forever
+                self.p.transport.abortConnection()
+            else:
+                self.p.transport.loseConnection()
+        self._fireConnected()
+
+    def motionBatchReceived(self, timestamps, xyz):
+        MotionProcessProtocol.motionBatchReceived(self, timestamps, xyz)
+        if self.state == 'stopped':
+            return None
+        if self.p is None:
+            if self._connected is None:
+                self._connected = defer.Deferred()
+            return self._connected
+        if self.p.paused:
+            return self.p.whenWritable()
+        return None
+
+    def _fireConnected(self):
+        d, self._connected = self._connected, None
+        if d is not None:
+            d.callback(None)
+
     def motionReceived(self, motion):
-        # If we have a connection, send the data on
-        if hasattr(self, 'p'):
-            self.p.sendMessage(motion)
+        # If we have a connection that is keeping up, send the data on;
+        # otherwise keep it, in order, for replay
+        p = self.p
+        if p is not None and not p.paused and not self.backlog:
+            p.sendMessage(motion)
         else:
-            self.open_outbound()
+            if len(self.backlog) == self.max_backlog:
+                self.stats['overflow'] += 1
+            self.backlog.append((time.time(), motion))
+            if p is not None:
+                self.replay()
 
-        log.debug('got "%s"' % str(motion))
+        log.debug('got "%s"', motion)
 
 
     def gotProtocol(self, p):
         """
         Callback from TCP4 endpoint. Saves the protocol instance for later.
         """
+        if self.state == 'stopped':
+            p.transport.loseConnection()
+            return
         self.p = p
+        if self.prefix is not None:
+            p.prefix = self.prefix
+        self.state = 'connected'
+        self.delay = self.initial_delay
+        self.stats['connects'] += 1
         log.debug('got protocol')
+        # closed fires with the connectionLost reason, a Failure
+        p.closed.addBoth(self.outboundLost)
+        self.replay()
+        self._fireConnected()
 
     def noProtocol(self, failure):
         """
         Errback from TCP4 endpoint, called if we get a connection error.
         """
         log.debug('Error getting outbound TCP connection: %s' % str(failure))
+        if self.state != 'stopped':
+            self.retry()
+
+    def outboundLost(self, reason):
+        log.debug('Outbound connection lost: %s' % str(reason))
+        # Samples a buffering sender had not written yet go out again on
+        # the next connection
+        for now, motion in getattr(self.p, 'unsent', ()):
+            if len(self.backlog) == self.max_backlog:
+                self.stats['overflow'] += 1
+            self.backlog.append((now, motion))
+            self.stats['recovered'] += 1
+        self.p = None
+        self.stats['disconnects'] += 1
+        if self.state != 'stopped':
+            self.retry()
+
+    def replay(self):
+        """
+        Send the samples buffered while we were disconnected or the
+        sender was paused. Stops when the sender pauses, and carries on
+        once it resumes.
+        """
+        p = self.p
+        while self.backlog and p is not None and not p.paused:
+            now, motion = self.backlog.popleft()
+            p.sendMessage(motion, now)
+            self.stats['replayed'] += 1
+        if self.backlog and p is not None and self._replay_wait is not p:
+            self._replay_wait = p
+            p.whenWritable().addCallback(self._writable, p)
+
+    def _writable(self, result, p):
+        if self._replay_wait is p:
+            self._replay_wait = None
+        if p is self.p:
+            self.replay()
+        return result
+
+    def retry(self):
+        self.state = 'waiting'
+        delay = self.delay * random.uniform(1 - self.jitter, 1 + self.jitter)
+        self.delay = min(self.delay * self.factor, self.max_delay)
+        log.debug('Reconnecting in %.1f seconds' % delay)
+        self._retry_call = reactor.callLater(delay, self._reconnect)
+
+    def _reconnect(self):
+        self._retry_call = None
+        self.state = 'disconnected'
+        self.open_outbound()
 
     def open_outbound(self):
+        if self.state != 'disconnected':
+            return
+        self.state = 'connecting'
+        self.stats['attempts'] += 1
         log.debug('Connected, opening outbound connection')
         factory = protocol.Factory()
-        factory.protocol = GraphiteSender
+        factory.protocol = self.senderProtocol
         point = TCP4ClientEndpoint(reactor, self.hostname, self.portnum)
         d = point.connect(factory)
         d.addCallback(self.gotProtocol)
         d.addErrback(self.noProtocol)
 
 
+class SinkQueue(object):
+    """
+    One sink of a MotionHub: a MotionProcessProtocol fed from a queue of
+    at most max_queued samples, drained blocks_per_turn blocks at a time
+    in its own reactor call, so a slow sink only falls behind itself.
+
+    When the queue is full, policy picks what goes: 'drop_oldest' blocks
+    already queued, 'drop_newest' the incoming block, or 'latest' keeps
+    just the newest sample, for sinks like the LED where only the last
+    value matters.
+
+    If the sink's motionBatchReceived returns a Deferred, nothing more is
+    handed to it until that fires.
+    """
+
+    def __init__(self, name, sink, max_queued=10000, policy='drop_oldest',
+                 blocks_per_turn=10):
+        if policy not in SINK_POLICIES:
+            raise ValueError('policy must be one of %s' % (SINK_POLICIES,))
+        self.name = name
+        self.sink = sink
+        self.max_queued = max_queued
+        self.policy = policy
+        self.blocks_per_turn = blocks_per_turn
+        self.queue = collections.deque()
+        self.queued = 0
+        self.busy = False
+        self.closed = False
+        self._call = None
+        self.stats = {'delivered':0, 'dropped':0}
+        self.lag_gauge = metrics.gauge('motion_sink_%s_lag_seconds' % name,
+                                       'Age of the oldest sample waiting for %s' % name)
+        self.dropped_counter = metrics.counter('motion_sink_%s_dropped_total' % name,
+                                               'Samples %s was too slow to take' % name)
+
+    def put(self, timestamps, xyz):
+        n = len(timestamps)
+        if self.policy == 'latest':
+            self._drop(self.queued)
+            self.queue.clear()
+            self.queued = 0
+            timestamps, xyz, n = timestamps[-1:], xyz[-3:], 1
+        elif self.policy == 'drop_newest' and self.queued + n > self.max_queued:
+            self._drop(n)
+            return
+        self.queue.append((timestamps, xyz))
+        self.queued += n
+        while self.queued > self.max_queued and len(self.queue) > 1:
+            old, _ = self.queue.popleft()
+            self.queued -= len(old)
+            self._drop(len(old))
+        self._schedule()
+
+    def _drop(self, n):
+        if n:
+            self.stats['dropped'] += n
+            self.dropped_counter.inc(n)
+
+    def _schedule(self):
+        if self._call is None and not self.busy and not self.closed and self.queue:
+            self._call = reactor.callLater(0, self.drain)
+
+    def drain(self, blocks=None):
+        """
+        Hand up to blocks (default blocks_per_turn) queued blocks to the
+        sink, and schedule another turn if any are left.
+        """
+        if self._call is not None and self._call.active():
+            self._call.cancel()
+        self._call = None
+        if blocks is None:
+            blocks = self.blocks_per_turn
+        while blocks and self.queue and not self.busy:
+            blocks -= 1
+            timestamps, xyz = self.queue.popleft()
+            self.queued -= len(timestamps)
+            self.stats['delivered'] += len(timestamps)
+            d = self.sink.motionBatchReceived(timestamps, xyz)
+            if isinstance(d, defer.Deferred):
+                self.busy = True
+                d.addBoth(self._resume)
+        self.lag_gauge.set(self.lag())
+        self._schedule()
+
+    def _resume(self, result):
+        self.busy = False
+        self._schedule()
+        return result
+
+    def close(self, reason):
+        """
+        Hand the sink whatever it will still take, then shut it down with
+        processEnded(reason).
+        """
+        self.drain(len(self.queue))
+        self.closed = True
+        if self._call is not None and self._call.active():
+            self._call.cancel()
+        self._call = None
+        self.sink.processEnded(reason)
+
+    def lag(self):
+        """
+        Seconds the oldest queued sample has been waiting, 0 if none.
+        """
+        if not self.queue:
+            return 0.0
+        return time.time() - self.queue[0][0][0]
+
+    def metrics(self):
+        m = dict(self.stats)
+        m.update({'queued':self.queued, 'lag':self.lag(),
+                  'policy':self.policy, 'busy':self.busy})
+        return m
+
+
+class MotionHub(MotionProcessProtocol):
+    """
+    Reads and parses the motion stream once and feeds every sample to
+    any number of sinks, each of them a MotionProcessProtocol such as
+    UDPProducingClient or TCPProducingClient. Each sink gets its own
+    SinkQueue, so a stalled Graphite connection or a slow LED does not
+    hold up the parser or the other sinks.
+
+        hub = MotionHub()
+        hub.addSink('statsd', UDPProducingClient())
+        hub.addSink('graphite', TCPProducingClient('localhost', 2003))
+        spawnProcess(reactor, hub, 100)
+    """
+
+    def __init__(self):
+        MotionProcessProtocol.__init__(self)
+        self.sinks = []
+
+    def addSink(self, name, sink, max_queued=10000, policy='drop_oldest',
+                blocks_per_turn=10):
+        """
+        Start feeding sink. Returns its SinkQueue.
+        """
+        q = SinkQueue(name, sink, max_queued, policy, blocks_per_turn)
+        self.sinks.append(q)
+        if self.transport is not None:
+            sink.makeConnection(self.transport)
+        return q
+
+    def removeSink(self, q, reason=None):
+        """
+        Stop feeding q's sink and shut it down, as if the process had
+        ended: its outbound connection and timers go with it.
+        """
+        self.sinks.remove(q)
+        if reason is None:
+            reason = failure.Failure(error.ProcessDone(0))
+        q.close(reason)
+
+    def connectionMade(self):
+        # The sinks share our transport, so they start up as they would
+        # if each had spawned the process itself
+        for q in self.sinks:
+            q.sink.makeConnection(self.transport)
+
+    def motionBatchReceived(self, timestamps, xyz):
+        for q in self.sinks:
+            q.put(timestamps, xyz)
+
+    def processEnded(self, reason):
+        MotionProcessProtocol.processEnded(self, reason)
+        for q in self.sinks:
+            q.close(reason)
+
+    def metrics(self):
+        """
+        Per sink queue depth, lag and drop counts, by sink name.
+        """
+        return dict([(q.name, q.metrics()) for q in self.sinks])
+
+
 def spawnProcess(reactor, processProtocol, interval):
     """
     Nifty Twisted trick - spawn a process, and hook its stdout into a Protocol.
@@ -188,7 +916,34 @@ if __name__ == '__main__':
         log.info('Try %s --help for usage details' % sys.argv[0])
         raise SystemExit, 1
 
-    #mp = TCPProducingClient(o.opts['host'], o.opts['port'])
-    mp = UDPProducingClient()
-    spawnProcess(reactor, mp, o.opts['interval'])
+    mp = MotionHub()
+    for name in o.opts['sinks'].split(','):
+        if name == 'statsd':
+            host, port = o.opts['statsd'].split(':')
+            mp.addSink(name, UDPProducingClient(host, port, o.opts['mtu'],
+                                                o.opts['prefix'] or 'paul.accel'))
+        elif name == 'graphite':
+            host, port = o.opts['graphite'].split(':')
+            mp.addSink(name, TCPProducingClient(host, port, o.opts['prefix']))
+        elif name == 'raw':
+            raw = TCPProducingClient(o.opts['host'], o.opts['port'])
+            raw.senderProtocol = Sender
+            mp.addSink(name, raw)
+        elif name == 'led':
+            import arduino
+            from integrated_demo import MotionToLight
+            mp.addSink(name, MotionToLight(arduino.Device()), policy='latest')
+        else:
+            log.error('Unknown sink %r' % name)
+            raise SystemExit, 1
+    task.LoopingCall(lambda: log.debug('sinks: %r', mp.metrics())).start(10.0, now=False)
+    rate = float(o.opts['rate']) or 1000.0 / float(o.opts['interval'])
+    if o.opts['source'] == 'motion':
+        spawnProcess(reactor, mp, o.opts['interval'])
+    elif o.opts['source'] == 'sim':
+        import motionsim
+        motionsim.spawnSimulator(reactor, mp, rate)
+    else:
+        import motionsim
+        motionsim.spawnReplay(reactor, mp, o.opts['source'], rate)
     reactor.run()
@@ -0,0 +1,160 @@
+#!/usr/bin/env python
+
+"""
+Stand-ins for the Mac-only 'motion' executable.
+
+A SampleSource feeds "x y z" lines to a MotionProcessProtocol (or any
+ProcessProtocol) at a set rate, the same way reactor.spawnProcess would,
+so the motion -> sender path can be run and load tested anywhere:
+
+    mp = motion.UDPProducingClient()
+    spawnSimulator(reactor, mp, rate=20000, chunk=(64, 4096))
+
+Lines come from a synthetic generator or are replayed from a file of
+recorded output. With chunk set, the stream is cut into reads of that
+many bytes (or a random size in a (low, high) range), so reads hold
+several lines and end part way through one, like a busy pipe.
+"""
+
+import math
+import random
+import itertools
+
+from twisted.internet import error
+from twisted.internet import task
+from twisted.python import failure
+
+
+def synthetic_lines(count=4096, seed=None):
+    """
+    count lines of a slowly tilting, noisy accelerometer.
+    """
+    rnd = random.Random(seed)
+    lines = []
+    for i in xrange(count):
+        a = 2 * math.pi * i / count
+        lines.append('%f %f %f\n' % (40 * math.sin(a) + rnd.gauss(0, 2),
+                                     40 * math.cos(a) + rnd.gauss(0, 2),
+                                     250 + rnd.gauss(0, 2)))
+    return lines
+
+
+def replay_lines(path):
+    """
+    The non-blank lines of a file of recorded 'motion' output.
+    """
+    f = open(path)
+    try:
+        return [line.strip() + '\n' for line in f if line.strip()]
+    finally:
+        f.close()
+
+
+class SourceTransport(object):
+    """
+    Just enough of a process transport for the protocol to stop us.
+    """
+    pid = None
+
+    def __init__(self, source):
+        self.source = source
+
+    def loseConnection(self):
+        self.source.stop()
+
+    def signalProcess(self, signal):
+        self.source.stop()
+
+    def closeStdin(self):
+        pass
+
+
+class SampleSource(object):
+    """
+    Writes lines to protocol.outReceived at rate lines per second, every
+    tick seconds. Cycles through lines forever unless loop is False.
+    """
+
+    def __init__(self, reactor, protocol, lines, rate, chunk=None,
+                 tick=0.01, loop=True):
+        self.reactor = reactor
+        self.protocol = protocol
+        self.rate = rate
+        self.chunk = chunk
+        self.tick = tick
+        if loop:
+            self.lines = itertools.cycle(lines)
+        else:
+            self.lines = iter(lines)
+        self.sent = 0
+        self._due = 0.0
+        self._carry = ''
+        self._last = None
+        self.loop = task.LoopingCall(self._tick)
+        self.loop.clock = reactor
+
+    def start(self):
+        self.protocol.makeConnection(SourceTransport(self))
+        self._last = self.reactor.seconds()
+        self.loop.start(self.tick, now=False)
+
+    def stop(self):
+        if not self.loop.running:
+            return
+        self.loop.stop()
+        if self._carry:
+            self.protocol.outReceived(self._carry)
+            self._carry = ''
+        self.protocol.processEnded(failure.Failure(error.ProcessDone(0)))
+
+    def _tick(self):
+        now = self.reactor.seconds()
+        self._due += self.rate * (now - self._last)
+        self._last = now
+        count = int(self._due)
+        self._due -= count
+
+        lines = list(itertools.islice(self.lines, count))
+        self.sent += len(lines)
+        if self.chunk is None:
+            for line in lines:
+                self.protocol.outReceived(line)
+        else:
+            self._write(''.join(lines))
+        if len(lines) < count:
+            self.stop()
+
+    def _write(self, data):
+        data = self._carry + data
+        i = 0
+        size = self._chunkSize()
+        while len(data) - i >= size:
+            self.protocol.outReceived(data[i:i + size])
+            i += size
+            size = self._chunkSize()
+        self._carry = data[i:]
+
+    def _chunkSize(self):
+        if isinstance(self.chunk, tuple):
+            return random.randint(*self.chunk)
+        return self.chunk
+
+
+def spawnSimulator(reactor, processProtocol, rate, chunk=None, seed=None):
+    """
+    Like motion.spawnProcess, with synthetic samples at rate per second.
+    """
+    source = SampleSource(reactor, processProtocol, synthetic_lines(seed=seed),
+                          rate, chunk)
+    source.start()
+    return source
+
+
+def spawnReplay(reactor, processProtocol, path, rate, chunk=None, loop=True):
+    """
+    Like motion.spawnProcess, replaying recorded output at rate per second.
+    """
+    source = SampleSource(reactor, processProtocol, replay_lines(path), rate,
+                          chunk, loop=loop)
+    source.start()
+    return source
@@ -0,0 +1,237 @@
+#!/usr/bin/env python
+
+"""
+The demo2 web page, served by several processes.
+
+A coordinator process owns the arduino.Device: it is the only one that
+polls it, once per interval. It opens the web listening socket and
+spawns worker processes which inherit it, so all of them accept
+connections on WEB_PORT and render pages and static files in parallel.
+Each reading is sent to every worker down its stdin as a JSON line;
+color changes posted to a worker come back up its stdout.
+
+$ python multicore.py --workers 4
+
+then browse to http://localhost:8000/demo as with demo2. To run against
+the emulator instead of the real device:
+
+$ python emulator.py --port 8080 &
+$ python multicore.py --device 127.0.0.1:8080
+"""
+import os
+import sys
+import json
+import socket
+import logging
+import multiprocessing
+
+from twisted.internet import defer
+from twisted.internet import protocol
+from twisted.internet import reactor
+from twisted.internet import stdio
+from twisted.protocols import basic
+from twisted.python import usage
+from twisted.web import server
+
+import arduino
+from integrated_demo import DeviceControlPage, DevicePoller, WEB_PORT
+
+
+class MOptions(usage.Options):
+    optParameters = [
+    ['workers', 'w', multiprocessing.cpu_count(), 'Number of web worker processes'],
+    ['port', 'p', WEB_PORT, 'Web port'],
+    ['interval', 'i', 5.0, 'Device polling interval, seconds'],
+    ['device', 'd', 'ooi-arduino.ucsd.edu:80', 'Arduino host:port, e.g. an emulator'],
+    ['worker', None, None, 'Internal: run as a worker on this listening fd'],
+    ]
+
+
+class WorkerProcess(protocol.ProcessProtocol):
+    """
+    The coordinator's end of one worker.
+    """
+
+    def __init__(self, coordinator):
+        self.coordinator = coordinator
+        self._buffer = ''
+
+    def connectionMade(self):
+        self.coordinator.workers.append(self)
+        latest = self.coordinator.poller.latest
+        if latest is not None:
+            self.send(json.dumps(latest) + '\n')
+
+    def send(self, line):
+        self.transport.write(line)
+
+    def outReceived(self, data):
+        self._buffer += data
+        lines = self._buffer.split('\n')
+        self._buffer = lines.pop()
+        for line in lines:
+            if line.startswith('color '):
+                self.coordinator.set_color(line[len('color '):].strip())
+
+    def processEnded(self, reason):
+        logging.info('Worker ended: %s' % (reason.value,))
+        self.coordinator.workerEnded(self)
+
+
+class Coordinator(object):
+
+    def __init__(self, device, port=WEB_PORT, workers=2, interval=5.0):
+        self.device = device
+        self.port = port
+        self.count = workers
+        self.poller = DevicePoller(device, interval)
+        self.poller.addListener(self.publish)
+        self.workers = []
+        self.running = False
+        self.sock = None
+
+    def start(self):
+        # Created here, not by the reactor, so the workers can inherit it
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.sock.bind(('', self.port))
+        self.sock.listen(128)
+        self.sock.setblocking(False)
+        self.running = True
+        self.poller.start()
+        for i in xrange(self.count):
+            self.spawn()
+
+    def stop(self):
+        self.running = False
+        self.poller.stop()
+        for worker in self.workers:
+            worker.transport.signalProcess('TERM')
+
+    def spawn(self):
+        fd = self.sock.fileno()
+        reactor.spawnProcess(WorkerProcess(self), sys.executable,
+                             [sys.executable, os.path.abspath(__file__),
+                              '--worker', str(fd)],
+                             env=os.environ,
+                             childFDs={0:'w', 1:'r', 2:2, fd:fd})
+
+    def workerEnded(self, worker):
+        if worker in self.workers:
+            self.workers.remove(worker)
+        if self.running:
+            self.spawn()
+
+    def publish(self, reading):
+        line = json.dumps(reading) + '\n'
+        for worker in self.workers:
+            worker.send(line)
+
+    def set_color(self, color):
+        self.device.set_color(color)
+
+
+class CoordinatorLink(basic.LineReceiver):
+    """
+    A worker's end of the coordinator channel, on stdin/stdout. Stands in
+    for both the arduino.Device and the DevicePoller of the page.
+
+    Until the first reading arrives get_data() waits for it, but for no
+    more than timeout seconds before failing with defer.TimeoutError.
+    """
+    delimiter = '\n'
+
+    def __init__(self, timeout=10):
+        self.color = arduino.WHITE
+        self.latest = None
+        self.listeners = []
+        self.timeout = timeout
+        self._waiting = []
+
+    def addListener(self, listener):
+        self.listeners.append(listener)
+
+    def removeListener(self, listener):
+        self.listeners.remove(listener)
+
+    def lineReceived(self, line):
+        # json gives back unicode, and the page must be rendered from str
+        latest = {}
+        for k, v in json.loads(line).items():
+            if isinstance(v, unicode):
+                v = v.encode('utf-8')
+            latest[k.encode('utf-8')] = v
+        self.latest = latest
+        self.color = self.latest['color']
+        reading = (self.latest['temp'], self.latest['humidity'],)
+        waiting, self._waiting = self._waiting, []
+        for d, timer in waiting:
+            timer.cancel()
+            d.callback(reading)
+        for listener in self.listeners:
+            listener(self.latest)
+
+    def connectionLost(self, reason):
+        # The coordinator has gone, so should we
+        if reactor.running:
+            reactor.stop()
+
+    def get_data(self):
+        """
+        The latest reading, or the first one once it arrives.
+        """
+        if self.latest is not None:
+            return defer.succeed((self.latest['temp'], self.latest['humidity'],))
+        d = defer.Deferred(self._cancel_wait)
+        timer = reactor.callLater(self.timeout, self._expire, d)
+        self._waiting.append((d, timer))
+        return d
+
+    def _cancel_wait(self, d):
+        for w, timer in self._waiting:
+            if w is d:
+                timer.cancel()
+        self._waiting = [(w, t) for (w, t) in self._waiting if w is not d]
+
+    def _expire(self, d):
+        self._waiting = [(w, t) for (w, t) in self._waiting if w is not d]
+        d.errback(defer.TimeoutError('No reading from the coordinator in %s seconds'
+                                     % (self.timeout,)))
+
+    def set_color(self, rgb):
+        self.color = rgb
+        self.sendLine('color %s' % (rgb,))
+        return defer.succeed(True)
+
+
+def worker(fd):
+    link = CoordinatorLink()
+    stdio.StandardIO(link)
+    site = server.Site(DeviceControlPage(link, link))
+    reactor.adoptStreamPort(fd, socket.AF_INET, site)
+    reactor.run()
+
+
+def coordinator(port, workers, interval, device='ooi-arduino.ucsd.edu:80'):
+    host, dport = device.split(':')
+    c = Coordinator(arduino.Device(host, int(dport)), port, workers, interval)
+    reactor.callWhenRunning(c.start)
+    reactor.addSystemEventTrigger('before', 'shutdown', c.stop)
+    reactor.run()
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(process)d %(levelname)s [%(funcName)s] %(message)s')
+
+    o = MOptions()
+    try:
+        o.parseOptions()
+    except usage.UsageError, errortext:
+        logging.error('%s %s' % (sys.argv[0], errortext))
+        raise SystemExit, 1
+
+    if o.opts['worker'] is not None:
+        worker(int(o.opts['worker']))
+    else:
+        coordinator(int(o.opts['port']), int(o.opts['workers']),
+                    float(o.opts['interval']), o.opts['device'])
@@ -0,0 +1,241 @@
+#!/usr/bin/env python
+
+"""
+Binary append log for full rate sensor and motion samples.
+
+Every record is a float64 timestamp followed by a fixed number of
+float32 fields. Records are packed straight into a memory-mapped segment
+file, so an append is a memory copy with no system call. Dirty pages are
+written out with fsync from a thread every sync_interval seconds, and a
+segment that is full is flushed and closed in a thread too. The next
+segment file is created and sized in a thread ahead of time, so the
+reactor thread never waits on the disk.
+
+fsync, not mmap.flush: Python 2's mmap.flush holds the GIL through the
+msync, which would stall the reactor thread just the same. fsync
+releases it, and on Linux also writes out the pages dirtied through a
+shared mapping.
+
+Segments are named <name>-000000.slog, <name>-000001.slog, ...  Each
+starts with a 16 byte header: magic, field count and the number of
+records written so far.
+
+    log = SampleLog('/var/tmp', 'motion', 3)
+    log.start()
+    log.append(time.time(), (x, y, z))
+
+    samples = read_segment('/var/tmp/motion-000000.slog', ('x', 'y', 'z'))
+    samples['x'].mean()
+"""
+
+import os
+import mmap
+import struct
+import logging
+
+from twisted.internet import defer
+from twisted.internet import task
+from twisted.internet import threads
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+MAGIC = 'SLG1'
+# magic, field count, unused, record count
+HEADER = struct.Struct('<4sHHQ')
+
+
+class Segment(object):
+    """
+    One preallocated, memory-mapped segment file.
+    """
+
+    def __init__(self, path, fields, capacity):
+        self.path = path
+        self.record = struct.Struct('<d%df' % fields)
+        self.capacity = capacity
+        self.count = 0
+        size = HEADER.size + capacity * self.record.size
+        self.file = open(path, 'w+b')
+        self.file.truncate(size)
+        self.map = mmap.mmap(self.file.fileno(), size)
+        HEADER.pack_into(self.map, 0, MAGIC, fields, 0, 0)
+
+    def full(self):
+        return self.count >= self.capacity
+
+    def append(self, t, values):
+        self.record.pack_into(self.map, HEADER.size + self.count * self.record.size,
+                              t, *values)
+        self.count += 1
+        # Publish the new length for readers of a live segment
+        struct.pack_into('<Q', self.map, 8, self.count)
+
+    def flush(self):
+        os.fsync(self.file.fileno())
+
+    def close(self):
+        self.flush()
+        self.map.close()
+        self.file.close()
+
+    def rename(self, path):
+        # The open file and the mapping follow the rename
+        os.rename(self.path, path)
+        self.path = path
+
+    def remove(self):
+        self.map.close()
+        self.file.close()
+        os.remove(self.path)
+
+
+class SampleLog(object):
+
+    def __init__(self, directory, name, fields, records_per_segment=1 << 20,
+                 sync_interval=5.0):
+        self.directory = directory
+        self.name = name
+        self.fields = fields
+        self.records_per_segment = records_per_segment
+        self.sync_interval = sync_interval
+        self.number = -1
+        self.segment = None
+        self._syncing = None
+        # The next segment, created in a thread under a temporary name
+        self._spare = None
+        self._preparing = None
+        self.loop = task.LoopingCall(self.sync)
+        self._roll()
+
+    def start(self):
+        self.loop.start(self.sync_interval, now=False)
+
+    def stop(self):
+        if self.loop.running:
+            self.loop.stop()
+
+    def append(self, t, values):
+        if self.segment.full():
+            self._roll()
+        self.segment.append(t, values)
+
+    def append_block(self, timestamps, values):
+        """
+        Append a block of samples; values is flat, fields floats per sample.
+        """
+        n = self.fields
+        for i, t in enumerate(timestamps):
+            self.append(t, values[i * n:(i + 1) * n])
+
+    def sync(self):
+        """
+        msync the current segment in a thread. At most one sync runs at a
+        time; the returned Deferred fires when it is done.
+        """
+        if self._syncing is not None:
+            return self._syncing
+        self._syncing = threads.deferToThread(self.segment.flush)
+        self._syncing.addErrback(self._sync_err)
+        self._syncing.addBoth(self._synced)
+        return self._syncing
+
+    def close(self):
+        self.stop()
+        if self._preparing is not None:
+            self._preparing.addCallback(self._discard)
+        elif self._spare is not None:
+            self._discard(self._spare)
+        return self._retire(self.segment)
+
+    def _synced(self, result):
+        self._syncing = None
+        return result
+
+    def _sync_err(self, reason):
+        logging.error('Sample log sync failed: %s' % (reason,))
+
+    def _roll(self):
+        if self.segment is not None:
+            self._retire(self.segment)
+        self.number += 1
+        path = os.path.join(self.directory, '%s-%06d.slog' % (self.name, self.number))
+        segment, self._spare = self._spare, None
+        if segment is not None:
+            segment.rename(path)
+        else:
+            # The first segment, or the spare is not ready yet; this one
+            # is created on the reactor thread
+            if self.segment is not None:
+                logging.warning('Sample log spare segment not ready, creating %s' % (path,))
+            segment = Segment(path, self.fields, self.records_per_segment)
+        self.segment = segment
+        self._prepare()
+
+    def _prepare(self):
+        """
+        Create and size the next segment in a thread, ready for _roll.
+        """
+        if self._preparing is not None or self._spare is not None:
+            return
+        path = os.path.join(self.directory, '%s.spare' % (self.name,))
+        self._preparing = threads.deferToThread(Segment, path, self.fields,
+                                                self.records_per_segment)
+        self._preparing.addCallbacks(self._prepared, self._prepare_err)
+
+    def _prepared(self, segment):
+        self._preparing = None
+        self._spare = segment
+        return segment
+
+    def _prepare_err(self, reason):
+        self._preparing = None
+        logging.error('Sample log could not create a spare segment: %s' % (reason,))
+
+    def _discard(self, segment):
+        """
+        Remove an unused spare segment, in a thread.
+        """
+        if segment is None:
+            return
+        self._spare = None
+        d = threads.deferToThread(segment.remove)
+        d.addErrback(self._sync_err)
+        return d
+
+    def _retire(self, segment):
+        """
+        Flush and close a segment in a thread, after any sync in progress.
+        """
+        d = defer.Deferred()
+        if self._syncing is not None:
+            self._syncing.addBoth(lambda result: d.callback(None) or result)
+        else:
+            d.callback(None)
+        d.addCallback(lambda _: threads.deferToThread(segment.close))
+        d.addErrback(self._sync_err)
+        return d
+
+
+def read_segment(path, names=None):
+    """
+    Map a segment read-only and return its records as a NumPy structured
+    array viewing the file, without copying it. Fields are named 't' and
+    then names, or f0, f1, ... by default.
+    """
+    if numpy is None:
+        raise ImportError('read_segment needs numpy')
+    f = open(path, 'rb')
+    try:
+        mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    finally:
+        f.close()
+    magic, fields, unused, count = HEADER.unpack_from(mm, 0)
+    if magic != MAGIC:
+        raise ValueError('%s is not a sample log segment' % (path,))
+    if names is None:
+        names = ['f%d' % i for i in xrange(fields)]
+    dtype = numpy.dtype([('t', '<f8')] + [(n, '<f4') for n in names])
+    return numpy.frombuffer(mm, dtype=dtype, count=count, offset=HEADER.size)
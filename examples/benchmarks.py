@@ -0,0 +1,319 @@
+"""
+What do the patterns in these examples cost?
+
+Runs over loopback only and prints one JSON document, so results can be
+saved and compared across reactors, Python and Twisted versions:
+
+    $ python benchmarks.py > epoll-py27.json
+    $ python benchmarks.py --reactor poll --output poll-py27.json
+
+Measures:
+ * connection setup rate against protocol.ExampleProtocol, and the
+   connect/send/disconnect round trip of dataReceivedreturn.ExampleProtocol
+ * notweb.NotHTTP dataReceived throughput over loopback, for several
+   read sizes
+ * a chain of Deferred callbacks versus the same steps in inlineCallbacks
+   (see the warning in deferred_basics)
+ * resident memory per open connection
+
+The examples print on every event; stdout is sent to /dev/null while
+they run so the terminal is not what gets measured.
+"""
+import os
+import sys
+import json
+import time
+import timeit
+import platform
+
+from twisted.python import usage
+
+
+class BOptions(usage.Options):
+    optParameters = [
+    ['reactor', 'r', None, 'Reactor to install (select, poll, epoll, kqueue...)'],
+    ['output', 'o', None, 'Write the JSON here instead of stdout'],
+    ['connections', 'c', 2000, 'Connections for the setup rate test'],
+    ['bytes', 'b', 4 * 1024 * 1024, 'Bytes per throughput test'],
+    ['idle', 'i', 1000, 'Open connections for the memory test'],
+    ]
+
+CHUNK_SIZES = (16, 256, 4096, 65536)
+CHAIN_LENGTHS = (1, 10, 100)
+
+
+def rss():
+    """
+    Resident set size in bytes (Linux), else peak RSS from getrusage.
+    """
+    try:
+        f = open('/proc/self/statm')
+        try:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+        finally:
+            f.close()
+    except IOError:
+        import resource
+        maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        if sys.platform == 'darwin':
+            return maxrss
+        return maxrss * 1024
+
+
+def deferred_costs():
+    """
+    Seconds per step for chained callbacks and for inlineCallbacks.
+    """
+    from twisted.internet import defer
+
+    def step(x):
+        return x + 1
+
+    def chained(n):
+        d = defer.Deferred()
+        for i in xrange(n):
+            d.addCallback(step)
+        d.callback(0)
+        return d
+
+    @defer.inlineCallbacks
+    def inline(n):
+        x = 0
+        for i in xrange(n):
+            x = yield defer.succeed(step(x))
+        defer.returnValue(x)
+
+    results = []
+    for n in CHAIN_LENGTHS:
+        number = max(1, 20000 / n)
+        t_chain = min(timeit.repeat(lambda: chained(n), number=number, repeat=5))
+        t_inline = min(timeit.repeat(lambda: inline(n), number=number, repeat=5))
+        results.append({'steps':n,
+                        'chained_per_step':t_chain / (number * n),
+                        'inline_per_step':t_inline / (number * n)})
+    return results
+
+
+class Suite(object):
+    """
+    The network benchmarks, run one after another on the reactor.
+    """
+
+    def __init__(self, reactor, opts):
+        from twisted.internet import defer, protocol
+        import protocol as example_protocol
+        import notweb
+        import dataReceivedreturn
+
+        self.reactor = reactor
+        self.defer = defer
+        self.protocol = protocol
+        self.examples = (example_protocol, notweb, dataReceivedreturn)
+        self.connections = int(opts['connections'])
+        self.bytes = int(opts['bytes'])
+        self.idle = int(opts['idle'])
+        self.results = {}
+
+    def listen(self, protocolClass):
+        factory = self.protocol.Factory()
+        factory.protocol = protocolClass
+        return self.reactor.listenTCP(0, factory, interface='127.0.0.1')
+
+    def connect(self, port, protocolClass):
+        creator = self.protocol.ClientCreator(self.reactor, protocolClass)
+        return creator.connectTCP('127.0.0.1', port.getHost().port)
+
+    def run(self):
+        d = self.defer.succeed(None)
+        d.addCallback(lambda _: self.setup_rate())
+        d.addCallback(lambda _: self.round_trip_rate())
+        for size in CHUNK_SIZES:
+            d.addCallback(lambda _, size=size: self.throughput(size))
+        d.addCallback(lambda _: self.memory())
+        d.addCallback(lambda _: self.results)
+        return d
+
+    def _timed(self, d, started, key, count, unit):
+
+        def _done(_):
+            elapsed = time.time() - started
+            self.results[key] = {'count':count, 'seconds':elapsed,
+                                 unit:count / elapsed}
+        d.addCallback(_done)
+        return d
+
+    def setup_rate(self):
+        """
+        Connect to protocol.ExampleProtocol and hang up, 50 at a time.
+        """
+        port = self.listen(self.examples[0].ExampleProtocol)
+        sem = self.defer.DeferredSemaphore(50)
+
+        def _once():
+            d = self.connect(port, self.protocol.Protocol)
+            d.addCallback(lambda p: p.transport.loseConnection())
+            return d
+
+        started = time.time()
+        d = self.defer.gatherResults([sem.run(_once)
+                                      for i in xrange(self.connections)])
+        d = self._timed(d, started, 'connection_setup', self.connections, 'per_second')
+        d.addCallback(lambda _: port.stopListening())
+        return d
+
+    def round_trip_rate(self):
+        """
+        Send a line to dataReceivedreturn.ExampleProtocol and wait for it
+        to hang up on us.
+        """
+        port = self.listen(self.examples[2].ExampleProtocol)
+        sem = self.defer.DeferredSemaphore(50)
+        defer, protocol = self.defer, self.protocol
+
+        class Poke(protocol.Protocol):
+            def connectionMade(self):
+                self.closed = defer.Deferred()
+                self.transport.write('hello\n')
+
+            def connectionLost(self, reason):
+                self.closed.callback(None)
+
+        def _once():
+            d = self.connect(port, Poke)
+            d.addCallback(lambda p: p.closed)
+            return d
+
+        started = time.time()
+        d = self.defer.gatherResults([sem.run(_once)
+                                      for i in xrange(self.connections)])
+        d = self._timed(d, started, 'send_and_disconnect', self.connections, 'per_second')
+        d.addCallback(lambda _: port.stopListening())
+        return d
+
+    def throughput(self, size):
+        """
+        Stream self.bytes over loopback to notweb.NotHTTP, read size bytes
+        at a time. Twisted reads up to transport.bufferSize bytes per
+        dataReceived call, so that is set to size (the size of the
+        sender's writes makes no difference, the kernel merges them).
+        """
+        done = self.defer.Deferred()
+        expected = self.bytes - self.bytes % size
+        stats = {'received':0, 'calls':0}
+
+        NotHTTP = self.examples[1].NotHTTP
+
+        class Counting(NotHTTP):
+            def connectionMade(self):
+                NotHTTP.connectionMade(self)
+                self.transport.bufferSize = size
+
+            def dataReceived(self, data):
+                NotHTTP.dataReceived(self, data)
+                stats['received'] += len(data)
+                stats['calls'] += 1
+                if stats['received'] >= expected and not done.called:
+                    done.callback(None)
+
+        port = self.listen(Counting)
+        chunk = 'x' * size
+        started = time.time()
+
+        def _send(p):
+            for i in xrange(expected / size):
+                p.transport.write(chunk)
+            return done.addCallback(lambda _: p.transport.loseConnection())
+
+        def _done(_):
+            elapsed = time.time() - started
+            self.results.setdefault('data_received', []).append(
+                {'read_size':size, 'bytes':expected, 'seconds':elapsed,
+                 'bytes_per_second':expected / elapsed,
+                 'dataReceived_calls':stats['calls'],
+                 'mean_read_size':float(expected) / max(1, stats['calls'])})
+            return port.stopListening()
+
+        d = self.connect(port, self.protocol.Protocol)
+        d.addCallback(_send)
+        d.addCallback(_done)
+        return d
+
+    def memory(self):
+        """
+        Resident memory before and after opening self.idle connections to
+        notweb.NotHTTP. Both ends live in this process.
+        """
+        port = self.listen(self.examples[1].NotHTTP)
+        before = rss()
+        clients = []
+
+        def _opened(_):
+            after = rss()
+            self.results['memory'] = {'connections':self.idle,
+                                      'rss_before':before, 'rss_after':after,
+                                      'bytes_per_connection_pair':
+                                          float(after - before) / self.idle}
+            for p in clients:
+                p.transport.loseConnection()
+            return port.stopListening()
+
+        sem = self.defer.DeferredSemaphore(50)
+        dl = [sem.run(self.connect, port, self.protocol.Protocol).addCallback(
+              clients.append) for i in xrange(self.idle)]
+        d = self.defer.gatherResults(dl)
+        d.addCallback(_opened)
+        return d
+
+
+def main():
+    opts = BOptions()
+    try:
+        opts.parseOptions()
+    except usage.UsageError, errortext:
+        print >> sys.stderr, '%s %s' % (sys.argv[0], errortext)
+        raise SystemExit, 1
+
+    if opts['reactor']:
+        from twisted.application.reactors import installReactor
+        installReactor(opts['reactor'])
+    from twisted.internet import reactor
+    import twisted
+
+    report = {'python':platform.python_version(),
+              'implementation':platform.python_implementation(),
+              'platform':platform.platform(),
+              'twisted':twisted.__version__,
+              'reactor':reactor.__class__.__name__,
+              'started':time.time()}
+
+    stdout = sys.stdout
+    sys.stdout = open(os.devnull, 'w')
+
+    def _finish(results):
+        report.update(results)
+        report['deferreds'] = deferred_costs()
+        text = json.dumps(report, indent=2, sort_keys=True)
+        if opts['output']:
+            f = open(opts['output'], 'w')
+            f.write(text + '\n')
+            f.close()
+        else:
+            print >> stdout, text
+
+    def _failed(reason):
+        reason.printTraceback(file=sys.stderr)
+
+    def _start():
+        d = Suite(reactor, opts).run()
+        d.addCallback(_finish)
+        d.addErrback(_failed)
+        d.addBoth(lambda _: reactor.stop())
+
+    reactor.callWhenRunning(_start)
+    reactor.run()
+    # Only now, as connections still close (and print) on the way out
+    sys.stdout = stdout
+
+
+if __name__ == '__main__':
+    main()
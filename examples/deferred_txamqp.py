@@ -7,11 +7,15 @@ A client waiting for a connection? (maybe to complicated to explain)
 """
 import os
 import time
+import collections
 from twisted.internet import defer
 from twisted.internet import reactor
 from twisted.internet import protocol
 from twisted.internet import task
+from twisted.internet import interfaces
 from twisted.application import service
+from twisted.python import failure
+from zope.interface import implements
 
 from txamqp import spec
 from txamqp.content import Content
@@ -55,6 +59,359 @@ def msg_rate():
     print '%s msg/sec' %(str(rate),)
 
 
+# A faster publisher.
+#
+# send_messages builds a new payload and Content for every message, gives
+# up the reactor after each one, and reports the average rate since it
+# started. Publisher reuses one Content, publishes batch_size messages per
+# cooperator step, and stops publishing while the connection's write
+# buffer is full (it registers as the transport's producer), so memory
+# does not grow without bound when the broker is slower than we are.
+
+def transport_depth(transport):
+    """
+    Bytes waiting in a transport's write buffer, or for a LocalTransport
+    the messages waiting in the broker.
+    """
+    if hasattr(transport, 'depth'):
+        return transport.depth()
+    return (len(getattr(transport, 'dataBuffer', '')) +
+            getattr(transport, '_tempDataLen', 0))
+
+
+class RateMeter(object):
+    """
+    Message and byte rates over the last window seconds, rather than
+    since the start. depth is a callable giving the current queue depth.
+    """
+
+    def __init__(self, window=1.0, depth=None, name='published'):
+        self.window = window
+        self.depth = depth
+        self.name = name
+        self.count = 0
+        self.bytes = 0
+        self.rate = 0.0
+        self.byte_rate = 0.0
+        self._last = (time.time(), 0, 0)
+        self.loop = task.LoopingCall(self.tick)
+
+    def start(self):
+        self._last = (time.time(), self.count, self.bytes)
+        self.loop.start(self.window, now=False)
+
+    def stop(self):
+        if self.loop.running:
+            self.loop.stop()
+
+    def add(self, count, nbytes):
+        self.count += count
+        self.bytes += nbytes
+
+    def queue_depth(self):
+        if self.depth is None:
+            return 0
+        return self.depth()
+
+    def tick(self):
+        now = time.time()
+        then, count, nbytes = self._last
+        elapsed = now - then
+        self.rate = (self.count - count) / elapsed
+        self.byte_rate = (self.bytes - nbytes) / elapsed
+        self._last = (now, self.count, self.bytes)
+        print '%s: %.0f msg/sec %.0f bytes/sec, queue depth %d' % (
+            self.name, self.rate, self.byte_rate, self.queue_depth())
+
+
+class Publisher(object):
+    implements(interfaces.IPushProducer)
+
+    def __init__(self, client, chan, exchange, routing_key='foo',
+                 msg_size=10000, batch_size=100):
+        self.client = client
+        self.chan = chan
+        self.exchange = exchange
+        self.routing_key = routing_key
+        self.msg_size = msg_size
+        self.batch_size = batch_size
+        self.content = Content('x' * msg_size)
+        self.meter = RateMeter(
+            depth=lambda: transport_depth(client.transport))
+        self.task = None
+        self.done = False
+
+    def start(self):
+        """
+        Publish until stopped. Returns a Deferred that fires when we are.
+        """
+        self.client.transport.registerProducer(self, True)
+        self.meter.start()
+        self.task = task.cooperate(self._batches())
+        d = self.task.whenDone()
+        d.addBoth(self._stopped)
+        return d
+
+    def _stopped(self, result):
+        self.done = True
+        self.meter.stop()
+        # Otherwise the transport keeps calling us, and will not close
+        self.client.transport.unregisterProducer()
+        if isinstance(result, failure.Failure) and result.check(task.TaskStopped):
+            return None
+        return result
+
+    def _batches(self):
+        publish = self.chan.basic_publish
+        exchange = self.exchange
+        routing_key = self.routing_key
+        content = self.content
+        batch = xrange(self.batch_size)
+        batch_bytes = self.batch_size * self.msg_size
+        while True:
+            for i in batch:
+                publish(exchange=exchange, content=content,
+                        routing_key=routing_key)
+            self.meter.add(self.batch_size, batch_bytes)
+            yield None
+
+    def pauseProducing(self):
+        if not self.done:
+            self.task.pause()
+
+    def resumeProducing(self):
+        if not self.done:
+            self.task.resume()
+
+    def stopProducing(self):
+        if not self.done:
+            self.task.stop()
+
+
+# Consuming.
+#
+# basic_qos(prefetch_count) bounds how many unacknowledged messages the
+# broker sends us. Messages are handled by `concurrency` cooperative
+# workers pulling from the consumer's TimeoutDeferredQueue, and acked in
+# bulk: one basic_ack(multiple=True) for every ack_every messages, and
+# whatever is left every ack_interval seconds. multiple=True acks every
+# tag up to the given one, so we only ever ack up to the highest tag
+# below which all messages are done. Keep ack_every below prefetch, or
+# the broker stops sending before we ack. A message whose handler fails
+# is not acked: it is rejected straight away (and requeued, unless
+# requeue is False), and then counts as done, since a later multiple ack
+# does not touch tags that are no longer outstanding.
+
+class Consumer(object):
+
+    def __init__(self, client, chan, queue_name, handler, prefetch=500,
+                 ack_every=100, ack_interval=0.5, concurrency=10,
+                 requeue=True):
+        """
+        handler(msg) is called for every message, and may return a
+        Deferred.
+        """
+        self.client = client
+        self.chan = chan
+        self.queue_name = queue_name
+        self.handler = handler
+        self.prefetch = prefetch
+        self.ack_every = ack_every
+        self.ack_interval = ack_interval
+        self.concurrency = concurrency
+        self.requeue = requeue
+        self.queue = None
+        self.running = False
+        self.errors = 0
+        self._acked = 0
+        self._contiguous = 0
+        self._done = set()
+        self.meter = RateMeter(depth=lambda: len(self.queue.pending),
+                               name='consumed')
+        self.acker = task.LoopingCall(self.ack)
+
+    def start(self):
+        """
+        Returns a Deferred that fires once the workers are running.
+        """
+        d = self.chan.basic_qos(prefetch_count=self.prefetch)
+        d.addCallback(lambda _: self.chan.basic_consume(queue=self.queue_name,
+                                                        no_ack=False))
+        d.addCallback(lambda reply: self.client.queue(reply.consumer_tag))
+        d.addCallback(self._consume)
+        return d
+
+    def stop(self):
+        self.running = False
+        self.meter.stop()
+        if self.acker.running:
+            self.acker.stop()
+        self.ack()
+
+    def _consume(self, queue):
+        self.queue = queue
+        self.running = True
+        self.meter.start()
+        self.acker.start(self.ack_interval, now=False)
+        for i in xrange(self.concurrency):
+            task.cooperate(self._worker())
+
+    def _worker(self):
+        while self.running:
+            d = self.queue.get()
+            d.addCallback(self._handle)
+            yield d
+
+    def _handle(self, msg):
+        args = (msg.delivery_tag, len(msg.content.body))
+        d = defer.maybeDeferred(self.handler, msg)
+        d.addCallbacks(self._finished, self._handler_err,
+                       callbackArgs=args, errbackArgs=args)
+        return d
+
+    def _handler_err(self, reason, tag, nbytes):
+        self.errors += 1
+        reason.printTraceback()
+        self.chan.basic_reject(delivery_tag=tag, requeue=self.requeue)
+        self._finished(None, tag, nbytes)
+
+    def _finished(self, result, tag, nbytes):
+        self.meter.add(1, nbytes)
+        self._done.add(tag)
+        while self._contiguous + 1 in self._done:
+            self._contiguous += 1
+            self._done.remove(self._contiguous)
+        if self._contiguous - self._acked >= self.ack_every:
+            self.ack()
+
+    def ack(self):
+        if self._contiguous > self._acked:
+            self.chan.basic_ack(delivery_tag=self._contiguous, multiple=True)
+            self._acked = self._contiguous
+
+
+class LocalMessage(object):
+
+    def __init__(self, delivery_tag, content):
+        self.delivery_tag = delivery_tag
+        self.content = content
+
+
+class LocalReply(object):
+
+    def __init__(self, consumer_tag):
+        self.consumer_tag = consumer_tag
+
+
+class LocalTransport(object):
+    """
+    Stands in for the broker connection's transport. Like a real one with
+    a full write buffer, it pauses the registered producer while more than
+    high_water messages wait in the broker's backlog, and resumes it once
+    they are down to low_water.
+    """
+
+    def __init__(self, broker, high_water=10000, low_water=2000):
+        self.broker = broker
+        self.high_water = high_water
+        self.low_water = low_water
+        self.producer = None
+        self.paused = False
+
+    def registerProducer(self, producer, streaming):
+        self.producer = producer
+        self.paused = False
+
+    def unregisterProducer(self):
+        self.producer = None
+
+    def depth(self):
+        return len(self.broker.backlog)
+
+    def check(self):
+        if self.producer is None:
+            return
+        depth = len(self.broker.backlog)
+        if not self.paused and depth > self.high_water:
+            self.paused = True
+            self.producer.pauseProducing()
+        elif self.paused and depth <= self.low_water:
+            self.paused = False
+            self.producer.resumeProducing()
+
+
+class LocalBroker(object):
+    """
+    In-process stand-in for an AMQClient and its channel, covering what
+    Publisher and Consumer use. Everything published goes to the one
+    consumer, honouring basic_qos prefetch, so the two can be run and
+    measured without a broker. Its transport applies back-pressure to the
+    Publisher, as a real connection would.
+    """
+
+    def __init__(self):
+        self.transport = LocalTransport(self)
+        self.backlog = collections.deque()
+        self.prefetch = 0
+        # delivery tag: content, for everything not yet acked
+        self.outstanding = {}
+        self.tag = 0
+        self.consumer = None
+
+    # AMQClient
+    def channel(self, id):
+        return defer.succeed(self)
+
+    def queue(self, consumer_tag):
+        return defer.succeed(self.consumer)
+
+    # Channel
+    def channel_open(self):
+        return defer.succeed(None)
+
+    def queue_declare(self, **kw):
+        return defer.succeed(None)
+
+    def queue_bind(self, **kw):
+        return defer.succeed(None)
+
+    def basic_qos(self, prefetch_size=0, prefetch_count=0, global_=False):
+        self.prefetch = prefetch_count
+        return defer.succeed(None)
+
+    def basic_consume(self, queue='', no_ack=False, **kw):
+        self.consumer = TimeoutDeferredQueue()
+        return defer.succeed(LocalReply('local'))
+
+    def basic_publish(self, exchange='', routing_key='', content=None, **kw):
+        self.backlog.append(content)
+        self._deliver()
+
+    def basic_ack(self, delivery_tag=0, multiple=False):
+        if multiple:
+            self.outstanding = dict((t, c) for t, c in self.outstanding.items()
+                                    if t > delivery_tag)
+        else:
+            self.outstanding.pop(delivery_tag, None)
+        self._deliver()
+
+    def basic_reject(self, delivery_tag=0, requeue=True):
+        content = self.outstanding.pop(delivery_tag, None)
+        if requeue and content is not None:
+            self.backlog.appendleft(content)
+        self._deliver()
+
+    def _deliver(self):
+        if self.consumer is None:
+            return
+        while self.backlog and (not self.prefetch or
+                                len(self.outstanding) < self.prefetch):
+            self.tag += 1
+            content = self.outstanding[self.tag] = self.backlog.popleft()
+            self.consumer.put(LocalMessage(self.tag, content))
+        self.transport.check()
+
+
 ####################################################
 # txamqp boiler plate
 
@@ -98,7 +455,11 @@ def createClient(host='localhost', port=5672):
     return d
 
 
-def main(msg_size, ex_type):
+def main(msg_size, ex_type, batch_size=None):
+    """
+    Publish msg_size messages to ex_type forever. With batch_size, use a
+    Publisher instead of send_messages.
+    """
     global count
     global start_time
     @defer.inlineCallbacks
@@ -106,11 +467,66 @@ def main(msg_size, ex_type):
         chan = yield client.channel(1)
         yield chan.channel_open()
         defer.returnValue(chan)
+
+    def publish(client):
+        d = gotClient(client)
+        if batch_size is None:
+            d.addCallback(send_messages, msg_size, ex_type)
+        else:
+            d.addCallback(lambda chan: Publisher(client, chan, ex_type,
+                                                 msg_size=msg_size,
+                                                 batch_size=batch_size).start())
+        return d
+
     d = createClient('amoeba.ucsd.edu')
-    d.addCallback(gotClient)
-    d.addCallback(send_messages, msg_size, ex_type)
+    d.addCallback(publish)
+
+
+def consume(client, queue_name, ex_type, handler, **kw):
+    """
+    Declare queue_name, bind it to ex_type and start a Consumer on it.
+    Fires with the running Consumer.
+    """
+    @defer.inlineCallbacks
+    def setup():
+        chan = yield client.channel(2)
+        yield chan.channel_open()
+        yield chan.queue_declare(queue=queue_name, auto_delete=True)
+        yield chan.queue_bind(queue=queue_name, exchange=ex_type,
+                              routing_key='foo')
+        consumer = Consumer(client, chan, queue_name, handler, **kw)
+        yield consumer.start()
+        defer.returnValue(consumer)
+    return setup()
+
+
+def local_demo(msg_size=1000, batch_size=100, duration=10):
+    """
+    Publisher -> LocalBroker -> Consumer, all in this process. Both sides
+    print their rates every second, for duration seconds.
+    """
+    broker = LocalBroker()
+
+    def publish(consumer):
+        publisher = Publisher(broker, broker, 'amq.direct', msg_size=msg_size,
+                              batch_size=batch_size)
+        publisher.start()
+        reactor.callLater(duration, finish, publisher, consumer)
+
+    def finish(publisher, consumer):
+        publisher.stopProducing()
+        consumer.stop()
+        reactor.stop()
+
+    d = consume(broker, 'local', 'amq.direct', lambda msg: None)
+    d.addCallback(publish)
+    return d
 
 
 if __name__ == '__main__':
-    main(10000, 'amq.direct')
+    import sys
+    if sys.argv[1:] == ['local']:
+        local_demo()
+    else:
+        main(10000, 'amq.direct')
     reactor.run()